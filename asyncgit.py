@@ -0,0 +1,153 @@
+import os
+import shlex
+import asyncio
+import logging
+import weakref
+
+# ==================================================================================
+# asyncio counterparts of run.run() and git.Git, for driving many repositories
+# from one event loop: every command is a child process awaited by the loop,
+# no thread is tied up per command. The number of commands running at once is
+# bounded by a semaphore, pass the same one to every AsyncGit to bound them all.
+# This module needs Python 3.5 or newer.
+# Examples:
+#  semaphore = asyncio.Semaphore(32)
+#  repos = [ AsyncGit(path, semaphore = semaphore) for path in paths ]
+#  revisions = await asyncio.gather(*[ git.rev_parse("HEAD") for git in repos ])
+
+DEFAULT_CONCURRENCY = 64
+
+# run() calls not given a semaphore share their event loop's
+default_semaphores = weakref.WeakKeyDictionary()
+
+def default_semaphore():
+
+    loop = asyncio.get_event_loop()
+    semaphore = default_semaphores.get(loop)
+    if semaphore is None:
+        semaphore = default_semaphores[loop] = asyncio.Semaphore(DEFAULT_CONCURRENCY)
+    return semaphore
+
+class AsyncRunError(Exception):
+    def __init__(self, ex_info, errno = None, cmd = None, trace = None):
+        self.ex_info = ex_info
+        self.errno = errno
+        self.cmd = cmd
+        self.trace = trace
+
+    def __str__(self):
+        return self.ex_info
+
+class AsyncGitError(AsyncRunError):
+    pass
+
+# ==================================================================================
+async def run(cmd, cwd = None, verbose = False, raise_exception = True,
+              semaphore = None, stderr = asyncio.subprocess.STDOUT, input = None):
+
+    # One more goodie: if cmd is a string, split it here
+    if type(cmd) is not list:
+        cmd = shlex.split(cmd)
+
+    if verbose:
+        logging.info("Running command '%s', cwd '%s'", " ".join(cmd), cwd)
+
+    if semaphore is None:
+        semaphore = default_semaphore()
+
+    async with semaphore:
+        try:
+            process = await asyncio.create_subprocess_exec(*cmd, cwd = cwd,
+                                                           stdin = asyncio.subprocess.PIPE if input else None,
+                                                           stdout = asyncio.subprocess.PIPE,
+                                                           stderr = stderr)
+        except OSError as e:
+            # Command not found or is not executable
+            if raise_exception:
+                raise AsyncRunError(str(e), errno = e.errno, cmd = " ".join(cmd))
+            return str(e)
+
+        try:
+            output, _stderr = await process.communicate(input)
+        except asyncio.CancelledError:
+            # Don't leave the command running behind us
+            if process.returncode is None:
+                process.kill()
+                await process.wait()
+            raise
+
+    # We never need the trailing '\n', so get rid of it here
+    output = output.decode("utf-8", "surrogateescape").rstrip()
+    errno = process.returncode
+
+    if errno and raise_exception:
+        raise AsyncRunError(output, errno = errno, cmd = " ".join(cmd))
+
+    return output
+
+# ==================================================================================
+# Examples:
+#  git = AsyncGit("/path/to/repo")
+#  await git.fetch("origin")
+#  await git.rev_parse("--short HEAD")
+
+class AsyncGit:
+
+    def __init__(self, path = '.', verbose = False, raise_exception = True,
+                 semaphore = None, concurrency = DEFAULT_CONCURRENCY):
+
+        self.path = path
+        self.name = os.path.dirname(path)
+        self.verbose = verbose
+        self.raise_exception = raise_exception
+        # Created on first use, so that it belongs to the running event loop
+        self.semaphore = semaphore
+        self.concurrency = concurrency
+
+    # All git commands (unless overloaded) appear as coroutine methods here
+    def __getattr__(self, name):
+
+        if name.startswith("__") and name.endswith("__"):
+            raise AttributeError
+
+        # Git commands containing "-" will have "_" instead, e.g. git.ls_remote()
+        name = name.replace('_', '-')
+
+        return lambda *args, **kwargs: self.run("%s %s" % (name, " ".join(args)), **kwargs)
+
+    async def run(self, cmd, **kwargs):
+
+        if self.semaphore is None:
+            self.semaphore = asyncio.Semaphore(self.concurrency)
+
+        kwargs['cwd'] = kwargs.get('cwd', self.path)
+        kwargs['verbose'] = kwargs.get('verbose', self.verbose)
+        kwargs['raise_exception'] = kwargs.get('raise_exception', self.raise_exception)
+
+        if type(cmd) is not list:
+            cmd = shlex.split(cmd)
+
+        try:
+            return await run(["git"] + cmd, semaphore = self.semaphore, **kwargs)
+        except AsyncRunError as e:
+            raise AsyncGitError(e.ex_info, errno = e.errno, cmd = e.cmd)
+
+    # Overload default ls-remote with one that swallows stderror
+    async def ls_remote(self, *args, **kwargs):
+
+        kwargs['stderr'] = asyncio.subprocess.DEVNULL
+        return await self.run("ls-remote %s" % (" ".join(args)), **kwargs)
+
+    async def isrepo(self):
+
+        if not os.path.isdir(self.path):
+            return False
+
+        if await self.rev_parse("--is-inside-work-tree", raise_exception = False) == "true":
+            return True
+
+        return await self.rev_parse("--is-bare-repository", raise_exception = False) == "true"
+
+    async def current_revision(self, ref = 'HEAD'):
+
+        return await self.rev_parse(ref)
@@ -0,0 +1,297 @@
+#!/usr/bin/env python
+import os
+import sys
+import json
+import time
+import shutil
+import logging
+import argparse
+import tempfile
+import threading
+import subprocess
+
+import utils
+import svndiff
+import lsremote
+from git import Git, FetchCoordinator
+
+# ==================================================================================
+# Benchmarks for the Git class, run(), forall() and svn_diff_to_git() on synthetic
+# repositories of configurable size. Results are written as JSON, and can be
+# compared against an earlier run to catch regressions.
+# Examples:
+#  python bench.py --commits 20000 --version-refs 50000 --output today.json
+#  python bench.py --output today.json --compare yesterday.json --max-regression 1.25
+
+BRANCH = "master"
+
+# ==================================================================================
+# Synthetic repositories: a bare "remote" built with one fast-import run, and a
+# clone of it. The remote has 'commits' commits on master ('files' files, each commit
+# changes one of them), 'version_refs' v/master/0.0.N branches and 'pub_refs' pub-*
+# branches and v/master/pub-* tags spread over the history.
+
+def fast_import_stream(commits, files, version_refs, pub_refs):
+
+    stamp = 1400000000
+    for index in range(commits):
+        lines = [ "commit refs/heads/%s" % BRANCH,
+                  "mark :%d" % (index + 1),
+                  "committer Bench <bench@example.com> %d +0000" % (stamp + index),
+                  "data %d" % len("commit %d\n" % index),
+                  "commit %d" % index ]
+        if index:
+            lines.append("from :%d" % index)
+            changed = [ index % files ]
+        else:
+            changed = range(files)
+        for fnum in changed:
+            data = "file %d changed in commit %d\n" % (fnum, index)
+            lines += [ "M 100644 inline dir%d/file%d.txt" % (fnum % 100, fnum), "data %d" % len(data), data ]
+        yield "\n".join(lines) + "\n"
+
+    def mark(ref_index, num_refs):
+        return commits * (ref_index + 1) // (num_refs + 1) or 1
+
+    for index in range(version_refs):
+        yield "reset refs/heads/v/%s/0.0.%d\nfrom :%d\n\n" % (BRANCH, index, mark(index, version_refs))
+
+    for index in range(pub_refs):
+        commit_mark = mark(index, pub_refs)
+        yield "reset refs/heads/pub-20150206.%d\nfrom :%d\n\n" % (index, commit_mark)
+        yield "tag v/%s/pub-20150206.%d\nfrom :%d\ntagger Bench <bench@example.com> %d +0000\ndata 4\npub\n\n" % \
+              (BRANCH, index, commit_mark, stamp + commit_mark)
+
+def make_repos(workdir, commits, files, version_refs, pub_refs):
+
+    remote = os.path.join(workdir, "remote.git")
+    work = os.path.join(workdir, "work")
+
+    subprocess.check_call(["git", "init", "-q", "--bare", remote])
+    process = subprocess.Popen(["git", "fast-import", "--quiet"], cwd = remote, stdin = subprocess.PIPE)
+    for chunk in fast_import_stream(commits, files, version_refs, pub_refs):
+        process.stdin.write(chunk)
+    process.stdin.close()
+    if process.wait():
+        raise utils.RunError("git fast-import failed", errno = process.returncode)
+
+    subprocess.check_call(["git", "symbolic-ref", "HEAD", "refs/heads/%s" % BRANCH], cwd = remote)
+    subprocess.check_call(["git", "clone", "-q", remote, work])
+    # get_m_branch() looks for the manifest branch here
+    subprocess.check_call(["git", "update-ref", "refs/remotes/m/%s" % BRANCH, "refs/remotes/origin/%s" % BRANCH], cwd = work)
+    subprocess.check_call(["git", "pack-refs", "--all"], cwd = work)
+
+    return remote, work
+
+def make_svn_diff(size):
+
+    chunks = []
+    total = 0
+    index = 0
+    while total < size:
+        path = "branches/DEV_BRANCH/junos/lib/dir%d/file%d.c" % (index % 100, index)
+        chunk = "Index: junos/lib/dir%d/file%d.c\n" % (index % 100, index) + \
+                "=" * 67 + "\n" + \
+                "diff --git a/%s b/%s\n" % (path, path) + \
+                "--- a/%s  (revision 918415)\n" % path + \
+                "+++ b/%s  (working copy)\n" % path + \
+                "@@ -1,40 +1,40 @@\n" + \
+                "".join(" context line %d of file %d\n" % (line, index) for line in range(20)) + \
+                "".join("-old line %d\n+new line %d\n" % (line, line) for line in range(20))
+        chunks.append(chunk)
+        total += len(chunk)
+        index += 1
+
+    return "".join(chunks)
+
+# ==================================================================================
+# Timing
+
+def measure(func, repeat, warmup = False):
+
+    if warmup:
+        func()
+
+    times = []
+    for _run in range(repeat):
+        start = time.time()
+        func()
+        times.append(time.time() - start)
+
+    times.sort()
+    return { 'runs': repeat,
+             'min': times[0],
+             'median': times[len(times) // 2],
+             'mean': sum(times) / len(times),
+             'max': times[-1] }
+
+def run_benchmarks(args, remote, work):
+
+    results = {}
+
+    def bench(name, func, repeat = args.repeat, warmup = False, **extra):
+        logging.info("Running %s", name)
+        results[name] = measure(func, repeat, warmup)
+        results[name].update(extra)
+
+    # The same Git object for all runs (warm caches) and a new one for every run (cold)
+    git = Git(work)
+    head = git.rev_parse("HEAD")
+    middle = git.rev_parse("HEAD~%d" % (args.commits // 2))
+    version_sha = git.rev_parse("refs/remotes/origin/v/%s/0.0.0" % BRANCH) if args.version_refs else head
+
+    queries = [
+        ("rev", lambda git: git.rev("origin/%s" % BRANCH)),
+        ("branch_exists", lambda git: git.branch_exists("v/%s/0.0.0" % BRANCH)),
+        ("real_branches", lambda git: git.real_branches(fetch = False)),
+        ("remote_tags", lambda git: git.remote_tags(r"v/%s/pub-\d+" % BRANCH, fetch = False)),
+        ("first_repo_revision", lambda git: git.first_repo_revision(version_sha, BRANCH)),
+        ("last_repo_revision", lambda git: git.last_repo_revision(BRANCH, fetch = False)),
+        ("path_exists", lambda git: git.path_exists("dir0/file0.txt")),
+        ("path_exists.missing", lambda git: git.path_exists("no/such/file")),
+        ("dump_revision", lambda git: git.dump_revision(middle)),
+    ]
+    for name, query in queries:
+        bench(name, lambda: query(git), warmup = True)
+        bench("%s.cold" % name, lambda: query(Git(work)))
+
+    # Remote round trips: ls-remote of the bare remote, every time (cold) or through
+    # an ls-remote cache, and fetches from it, every time or through a fetch coordinator
+    ls_remote_cache = lsremote.LsRemoteCache(ttl = 3600, cache_dir = os.path.join(args.workdir, "ls-remote-cache"))
+    remote_queries = [
+        ("remote_tags", lambda git: git.remote_tags(r"v/%s/pub-\d+" % BRANCH, fetch = False)),
+        ("remote_heads", lambda git: git.remote_heads("v/%s/*" % BRANCH, remote = "origin", fetch = False)),
+    ]
+    for name, query in remote_queries:
+        bench("ls_remote.%s.cold" % name, lambda: query(Git(work, remote_repo = remote)))
+        bench("ls_remote.%s.cached" % name,
+              lambda: query(Git(work, remote_repo = remote, ls_remote_cache = ls_remote_cache)), warmup = True)
+
+    bench("fetch.cold", lambda: Git(work).fetch("origin", verbose = False))
+    fetches = FetchCoordinator(freshness = 3600)
+    bench("fetch.coordinated", lambda: Git(work, fetch_coordinator = fetches).fetch("origin", verbose = False),
+          warmup = True)
+
+    # Concurrent fetches of the same remote, each one for real or coalesced into one
+    def concurrent_fetches(coordinator = None):
+        fetch = lambda: Git(work, fetch_coordinator = coordinator).fetch("origin", verbose = False)
+        threads = [ threading.Thread(target = fetch) for _thread in range(args.concurrent_fetches) ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    bench("fetch.concurrent", concurrent_fetches, threads = args.concurrent_fetches)
+    bench("fetch.concurrent.coordinated", lambda: concurrent_fetches(FetchCoordinator()),
+          threads = args.concurrent_fetches)
+
+    # forall scaling: the same number of short git commands, more and more threads
+    entries = range(args.forall_entries)
+    def rev_parse(_entry):
+        utils.run(["git", "rev-parse", "HEAD"], cwd = work)
+        return 0
+    jobs = 1
+    while jobs <= args.max_jobs:
+        bench("forall.jobs_%d" % jobs, lambda: utils.forall(jobs, entries, rev_parse),
+              repeat = max(1, args.repeat // 2), jobs = jobs, entries = len(entries))
+        jobs *= 2
+
+    # run() streaming throughput
+    big_file = os.path.join(args.workdir, "stream.txt")
+    with open(big_file, "w") as fdesc:
+        line = "x" * 99 + "\n"
+        for _chunk in range(args.stream_mb * 1024 * 1024 // (len(line) * 1000)):
+            fdesc.write(line * 1000)
+    size = os.path.getsize(big_file)
+    bench("run.stream", lambda: utils.run(["cat", big_file], stdout = subprocess.PIPE, sinks = [ utils.TailSink() ]),
+          bytes = size)
+
+    # svn_diff_to_git on a multi-MB diff
+    svn_diff = make_svn_diff(args.svn_diff_mb * 1024 * 1024)
+    bench("svn_diff_to_git", lambda: svndiff.svn_diff_to_git("DEV_BRANCH", "", "junos/lib", svn_diff),
+          bytes = len(svn_diff))
+
+    # Throughput, where it makes sense
+    for name, result in results.items():
+        if 'bytes' in result and result['median']:
+            result['mb_per_second'] = result['bytes'] / result['median'] / (1024 * 1024)
+
+    return results
+
+# ==================================================================================
+# Comparing two result files: the ratio of median times, new / old
+
+def compare(results, baseline, max_regression):
+
+    regressions = []
+    for name in sorted(results):
+        if name not in baseline:
+            continue
+        old = baseline[name]['median']
+        new = results[name]['median']
+        ratio = new / old if old else 0
+        flag = ""
+        if ratio > max_regression:
+            flag = "  REGRESSION"
+            regressions.append(name)
+        print "%-32s %10.4fs %10.4fs %6.2fx%s" % (name, old, new, ratio, flag)
+
+    return regressions
+
+def main():
+
+    parser = argparse.ArgumentParser(description = "Benchmark git/run/svndiff on synthetic repositories")
+    parser.add_argument("--commits", type = int, default = 2000)
+    parser.add_argument("--files", type = int, default = 500)
+    parser.add_argument("--version-refs", type = int, default = 2000)
+    parser.add_argument("--pub-refs", type = int, default = 500)
+    parser.add_argument("--repeat", type = int, default = 5)
+    parser.add_argument("--forall-entries", type = int, default = 64)
+    parser.add_argument("--max-jobs", type = int, default = 16)
+    parser.add_argument("--concurrent-fetches", type = int, default = 8)
+    parser.add_argument("--stream-mb", type = int, default = 64)
+    parser.add_argument("--svn-diff-mb", type = int, default = 16)
+    parser.add_argument("--workdir", help = "Where to create the repositories (default: a temporary directory)")
+    parser.add_argument("--keep", action = "store_true", help = "Keep the repositories when done")
+    parser.add_argument("--output", help = "Write the results here (default: stdout)")
+    parser.add_argument("--compare", help = "Results of an earlier run to compare with")
+    parser.add_argument("--max-regression", type = float, default = 1.2,
+                        help = "Fail if a benchmark got slower than this ratio of its earlier median")
+    args = parser.parse_args()
+
+    temporary = not args.workdir
+    args.workdir = args.workdir or tempfile.mkdtemp(prefix = "git-bench-")
+
+    try:
+        logging.info("Creating repositories in %s", args.workdir)
+        start = time.time()
+        remote, work = make_repos(args.workdir, args.commits, args.files, args.version_refs, args.pub_refs)
+        setup = time.time() - start
+
+        results = run_benchmarks(args, remote, work)
+    finally:
+        if temporary and not args.keep:
+            shutil.rmtree(args.workdir, ignore_errors = True)
+
+    report = { 'params': { 'commits': args.commits, 'files': args.files, 'version_refs': args.version_refs,
+                           'pub_refs': args.pub_refs, 'repeat': args.repeat },
+               'git_version': subprocess.check_output(["git", "--version"]).strip(),
+               'python_version': sys.version.split()[0],
+               'setup_seconds': setup,
+               'results': results }
+
+    if args.output:
+        with open(args.output, "w") as fdesc:
+            json.dump(report, fdesc, indent = 2, sort_keys = True)
+    else:
+        print json.dumps(report, indent = 2, sort_keys = True)
+
+    if args.compare:
+        with open(args.compare) as fdesc:
+            baseline = json.load(fdesc)['results']
+        if compare(results, baseline, args.max_regression):
+            return 1
+
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,239 @@
+import time
+import logging
+
+# ==================================================================================
+# Rewrites a "git fast-export" stream into a "git fast-import" stream of the history
+# of one directory: the directory becomes the root, changes outside of it are dropped,
+# and so are commits left with no changes - their children, refs and tags move to the
+# nearest commit that is kept. Blobs, messages and identities pass through untouched.
+# Examples:
+#  extractor = PathExtractor("junos/lib")
+#  extractor.run(fast_export.stdout, fast_import.stdin)
+#  extractor.refs    ->  set(['refs/heads/master', 'refs/tags/v0.0.91', ...])
+#  extractor.stats() ->  {'commits': 1200, 'kept': 800, 'bytes': 52428800, ...}
+
+NULL_SHA = "0" * 40
+
+class PathExtractor:
+
+    def __init__(self, path, progress_interval = 5):
+
+        self.prefix = path.strip("/") + "/"
+        self.progress_interval = progress_interval
+        # Mark of a dropped commit -> mark of the commit replacing it (None if there is none)
+        self.marks = {}
+        # Refs (and tags) the output updates, everything else stays as it was
+        self.refs = set()
+        self.commits = 0
+        self.kept = 0
+        self.tags = 0
+        self.bytes = 0
+        self.start = self.last_report = time.time()
+
+    def stats(self):
+
+        seconds = time.time() - self.start
+        return { 'commits': self.commits, 'kept': self.kept, 'tags': self.tags, 'bytes': self.bytes,
+                 'seconds': seconds, 'mb_per_second': self.bytes / (seconds or 1) / (1024 * 1024) }
+
+    def report(self, force = False):
+
+        now = time.time()
+        if not force and now - self.last_report < self.progress_interval:
+            return
+        self.last_report = now
+
+        stats = self.stats()
+        logging.info("%d commits read, %d kept, %.1f MB in %ds (%.1f MB/s)", stats['commits'], stats['kept'],
+                     stats['bytes'] / (1024.0 * 1024), stats['seconds'], stats['mb_per_second'])
+
+    def readline(self):
+
+        line = self.input.readline()
+        self.bytes += len(line)
+        return line
+
+    # Reads "data <size>" and what follows, returns it all as it was
+    def read_data(self, line):
+
+        if not line.startswith("data "):
+            raise ValueError("Expected data, got %r" % line)
+        if line.startswith("data <<"):
+            raise ValueError("Delimited data is not supported")
+
+        data = self.input.read(int(line[len("data "):]))
+        self.bytes += len(data)
+        return line + data
+
+    # A commit-ish as the output knows it: marks of dropped commits are replaced,
+    # None if there is nothing to refer to
+    def commit_ref(self, ref):
+
+        if ref == NULL_SHA:
+            # fast-export's way of saying no commit of the ref is left
+            return None
+        return self.marks.get(ref, ref)
+
+    # Path inside the extracted directory, None if it's outside
+    def rewrite_path(self, path):
+
+        quote = ""
+        if path.startswith('"'):
+            # C-style quoted, the prefix itself never needs quoting
+            quote, path = '"', path[1:]
+
+        if path.startswith(self.prefix) and len(path) > len(self.prefix) + len(quote):
+            return quote + path[len(self.prefix):]
+
+    # "M 100644 :12 dir/file", "D dir/file", "deleteall"...
+    def rewrite_change(self, line):
+
+        line = line.rstrip("\n")
+        if line == "deleteall":
+            return line
+
+        if line.startswith("M "):
+            fields = line.split(" ", 3)
+            path = self.rewrite_path(fields[3])
+            if path:
+                return " ".join(fields[:3] + [ path ])
+        elif line.startswith("D "):
+            path = self.rewrite_path(line[len("D "):])
+            if path:
+                return "D " + path
+        elif line.startswith("N "):
+            # Notes aren't about paths
+            return line
+        elif line[:2] in ("R ", "C "):
+            raise ValueError("Copies and renames are not supported: %r" % line)
+
+        return None
+
+    def commit(self, line):
+
+        ref = line.rstrip("\n")[len("commit "):]
+        header = []
+        mark = None
+        line = self.readline()
+        while not line.startswith("data "):
+            if line.startswith("mark "):
+                mark = line.rstrip("\n")[len("mark "):]
+            header.append(line)
+            line = self.readline()
+        message = self.read_data(line)
+
+        parents = []
+        changes = []
+        line = self.readline()
+        while line and line != "\n":
+            if line.startswith("from ") or line.startswith("merge "):
+                parent = self.commit_ref(line.rstrip("\n").split(" ", 1)[1])
+                if parent is not None and parent not in parents:
+                    parents.append(parent)
+            else:
+                change = self.rewrite_change(line)
+                if change is not None:
+                    changes.append(change + "\n")
+            line = self.readline()
+
+        self.commits += 1
+
+        if not changes and len(parents) <= 1:
+            # Nothing left of it, its ref goes where its parent went
+            replacement = parents[0] if parents else None
+            self.marks[mark] = replacement
+            if replacement is None:
+                self.output.write("reset %s\n\n" % ref)
+                self.refs.discard(ref)
+            else:
+                self.output.write("reset %s\nfrom %s\n\n" % (ref, replacement))
+                self.refs.add(ref)
+            return
+
+        self.kept += 1
+        if not parents:
+            # Start from scratch even if the branch has commits already
+            self.output.write("reset %s\n" % ref)
+        self.output.write("commit %s\n" % ref)
+        self.output.write("".join(header))
+        self.output.write(message)
+        if not message.endswith("\n"):
+            self.output.write("\n")
+        for index, parent in enumerate(parents):
+            self.output.write("%s %s\n" % ("merge" if index else "from", parent))
+        self.output.write("".join(changes))
+        self.output.write("\n")
+        self.refs.add(ref)
+
+    def reset(self, line, next_line):
+
+        ref = line.rstrip("\n")[len("reset "):]
+        if not next_line.startswith("from "):
+            self.output.write(line)
+            return next_line
+
+        parent = self.commit_ref(next_line.rstrip("\n")[len("from "):])
+        if parent is None:
+            # Nothing to reset it to, the ref stays as it was
+            self.refs.discard(ref)
+        else:
+            self.output.write("%sfrom %s\n\n" % (line, parent))
+            self.refs.add(ref)
+        return self.readline()
+
+    def tag(self, line):
+
+        name = line.rstrip("\n")[len("tag "):]
+        lines = [ line ]
+        target = None
+        line = self.readline()
+        while not line.startswith("data "):
+            if line.startswith("from "):
+                target = self.commit_ref(line.rstrip("\n")[len("from "):])
+                line = "from %s\n" % target
+            lines.append(line)
+            line = self.readline()
+        lines.append(self.read_data(line))
+
+        if target is None:
+            # It tagged something that's gone
+            self.refs.discard("refs/tags/%s" % name)
+            return
+
+        self.tags += 1
+        self.output.write("".join(lines))
+        self.output.write("\n")
+        self.refs.add("refs/tags/%s" % name)
+
+    def run(self, input, output):
+
+        self.input = input
+        self.output = output
+
+        line = self.readline()
+        while line:
+            if line == "\n":
+                line = self.readline()
+                continue
+
+            if line.startswith("commit "):
+                self.commit(line)
+                self.report()
+            elif line.startswith("reset "):
+                line = self.reset(line, self.readline())
+                continue
+            elif line.startswith("tag "):
+                self.tag(line)
+            elif line.startswith("blob"):
+                mark = self.readline()
+                data_line = self.readline()
+                if not mark.startswith("mark "):
+                    mark, data_line = "", mark
+                self.output.write("blob\n%s%s\n" % (mark, self.read_data(data_line)))
+            else:
+                # feature, option, progress, checkpoint, done...
+                self.output.write(line)
+
+            line = self.readline()
+
+        self.report(force = True)
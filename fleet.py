@@ -0,0 +1,128 @@
+import os
+import time
+import logging
+import traceback
+import collections
+import xml.etree.ElementTree as ElementTree
+
+import utils
+from git import Git, GitError, FetchCoordinator
+from refs import RefCache
+from lsremote import LsRemoteCache
+
+# ==================================================================================
+# Runs Git methods across many repositories at once.
+# All repos share one fetch coordinator (and ls-remote cache), and repos that are the same git repo
+# (worktrees, or one checkout listed twice) share their ref snapshot too.
+# Every call returns one FleetResult per repo, in the order the repos were given.
+# Examples:
+#  fleet = GitFleet(["/src/repo1", "/src/repo2"], jobs = 16)
+#  fleet = GitFleet("/src/.repo/manifest.xml")
+#  for result in fleet.upstream_gain(fetch = True):
+#      print result.path, len(result.value or []), result.error, result.duration
+#  print format_fleet_results(fleet.run("tracks_published"))
+
+FleetResult = collections.namedtuple("FleetResult", "path value error duration")
+
+# A manifest is either a repo tool XML manifest (<project name="..." path="..."/>)
+# or a text file with one repo path per line. Relative paths are relative to 'top',
+# by default the directory holding .repo (for repo manifests) or the manifest itself.
+def read_manifest(manifest, top = None):
+
+    manifest = os.path.abspath(manifest)
+    if not top:
+        top = os.path.dirname(manifest)
+        while os.path.basename(top) in (".repo", "manifests"):
+            top = os.path.dirname(top)
+
+    if manifest.endswith(".xml"):
+        projects = ElementTree.parse(manifest).getroot().findall("project")
+        paths = [ project.get("path") or project.get("name") for project in projects ]
+    else:
+        with open(manifest) as fdesc:
+            paths = [ line.strip() for line in fdesc ]
+        paths = [ path for path in paths if path and not path.startswith("#") ]
+
+    return [ os.path.join(top, path) for path in paths ]
+
+class GitFleet:
+
+    def __init__(self, repos, jobs = 8, fetch_freshness = 0, ls_remote_ttl = 0, **kwargs):
+
+        if isinstance(repos, basestring):
+            repos = read_manifest(repos)
+
+        self.paths = list(repos)
+        self.jobs = jobs
+        self.fetches = FetchCoordinator(fetch_freshness)
+        self.ls_remote_cache = LsRemoteCache(ls_remote_ttl) if ls_remote_ttl else None
+
+        # Find out which repos share a git directory, so they can share a ref cache
+        common_dirs = {}
+        def find_common_dir(path):
+            try:
+                common_dirs[path] = os.path.realpath(Git(path).git_common_dir())
+            except GitError:
+                pass
+            return 0
+        utils.forall(jobs, self.paths, find_common_dir)
+
+        ref_caches = collections.defaultdict(RefCache)
+        self.gits = []
+        for path in self.paths:
+            ref_cache = ref_caches[common_dirs[path]] if path in common_dirs else None
+            self.gits.append(Git(path, fetch_coordinator = self.fetches, ref_cache = ref_cache,
+                                 ls_remote_cache = self.ls_remote_cache, **kwargs))
+
+    def __len__(self):
+
+        return len(self.gits)
+
+    # Every Git method is a fleet method too, e.g. fleet.rebase_repo(fetch = False)
+    def __getattr__(self, name):
+
+        if name.startswith("__") and name.endswith("__"):
+            raise AttributeError
+
+        return lambda *args, **kwargs: self.run(name, *args, **kwargs)
+
+    # Runs git.<method>(*args, **kwargs) in every repo. Failures in one repo don't stop
+    # the others: the exception lands in its FleetResult.error, the traceback is logged
+    def run(self, method, *args, **kwargs):
+
+        progress_bar_name = kwargs.pop('progress_bar_name', None)
+
+        results = [ None ] * len(self.gits)
+
+        # Always return 0, so that forall goes over all the repos
+        def call(entry):
+            index, git = entry
+            start = time.time()
+            try:
+                value = getattr(git, method)(*args, **kwargs)
+                error = None
+            except Exception, e:
+                logging.debug("%s failed in %s:\n%s", method, git.path, traceback.format_exc())
+                value = None
+                error = e
+            results[index] = FleetResult(git.path, value, error, time.time() - start)
+            return 0
+
+        utils.forall(self.jobs, list(enumerate(self.gits)), call, progress_bar_name = progress_bar_name)
+
+        return results
+
+    def close(self):
+
+        for git in self.gits:
+            git.close()
+
+def format_fleet_results(results):
+
+    width = max([ len(result.path) for result in results ] + [ len("repo") ])
+    lines = [ "%-*s  %8s  %s" % (width, "repo", "seconds", "result") ]
+    for result in results:
+        outcome = "ERROR: %s" % result.error if result.error else result.value
+        lines.append("%-*s  %8.3f  %s" % (width, result.path, result.duration, outcome))
+
+    return "\n".join(lines)
@@ -6,11 +6,26 @@ import shutil
 import errno
 import re
 import shlex
-from tempfile import NamedTemporaryFile
+import subprocess
+import threading
+import time
+import fnmatch
+from collections import namedtuple
+from tempfile import NamedTemporaryFile, TemporaryFile
 
 import commit
+import fastexport
+import gitdiff
+import gitfiles
+import gitpatterns
+import gitstatus
+import lsremote
+import pubtags
+import reach
+import refs
 import utils
-from revision import Revision, revision_branch_name
+import versions
+from revision import revision_branch_name
 
 # ============================================================================
 logging.basicConfig(level=logging.INFO, format='%(levelname)s: %(message)s')
@@ -18,9 +33,278 @@ logging.basicConfig(level=logging.INFO, format='%(levelname)s: %(message)s')
 GITIGNORE = ".gitignore"
 GITATTRIBUTES = ".gitattributes"
 
+# One commit from Git.walk_commits(): full sha, list of parent shas and
+# (if decorations were asked for) list of full names of refs pointing at it
+CommitEntry = namedtuple("CommitEntry", "sha parents refs")
+
+# Remote branches that are not real development branches
+SPECIAL_BRANCHES = re.compile(r"^v/.*|^pub-\d+\.\d+$|^build-\d+\.\d+$")
+
 class GitError(utils.RunError):
     pass
 
+# ==================================================================================
+# A long-lived "git cat-file --batch" (or "--batch-check") co-process.
+# Each query is a pipe round trip instead of a fork/exec of a new git process.
+# If the co-process dies or gets out of sync it is killed and restarted.
+# Examples:
+#  cat_file = CatFile("/path/to/repo", "--batch-check")
+#  cat_file.query("HEAD:README")   ->  ('1c2b...', 'blob', 123)
+#  cat_file = CatFile("/path/to/repo", "--batch")
+#  cat_file.query("HEAD:README")   ->  ('1c2b...', 'blob', 'file contents')
+#  cat_file.query("HEAD:MISSING")  ->  None
+#  cat_file.close()
+
+class CatFile:
+
+    def __init__(self, path = '.', batch = "--batch-check"):
+
+        self.path = path
+        self.batch = batch
+        self.process = None
+        self.lock = threading.Lock()
+
+    def __del__(self):
+
+        self.close(kill = True)
+
+    def start(self):
+
+        with open(os.devnull, 'w') as devnull:
+            self.process = subprocess.Popen(["git", "cat-file", self.batch], cwd = self.path,
+                                            stdin = subprocess.PIPE, stdout = subprocess.PIPE,
+                                            stderr = devnull)
+
+    def close(self, kill = False):
+
+        process, self.process = self.process, None
+        if not process:
+            return
+
+        try:
+            if kill:
+                process.kill()
+            # cat-file exits as soon as its input is closed
+            process.stdin.close()
+            process.wait()
+            process.stdout.close()
+        except (IOError, OSError):
+            pass
+
+    def _query(self, obj):
+
+        self.process.stdin.write(obj + "\n")
+        self.process.stdin.flush()
+
+        # The header looks like this:
+        # 1c2b6e0e3ab5a2b8bb4fa5ebba8d5b2fc8e4bd09 blob 123
+        # or, for objects we can't resolve:
+        # HEAD:no/such/file missing
+        header = self.process.stdout.readline()
+        if not header.endswith("\n"):
+            raise IOError(errno.EPIPE, "git cat-file exited")
+
+        header = header[:-1]
+        if header.endswith(" missing") or header.endswith(" ambiguous"):
+            return None
+
+        sha, obj_type, size = header.split(" ")
+        size = int(size)
+
+        if self.batch != "--batch":
+            return (sha, obj_type, size)
+
+        # Contents are followed by a single '\n'
+        data = self.process.stdout.read(size + 1)
+        if len(data) != size + 1:
+            raise IOError(errno.EPIPE, "git cat-file exited")
+
+        return (sha, obj_type, data[:-1])
+
+    # Returns (sha, type, size) for --batch-check, (sha, type, contents) for --batch
+    # or None if the object does not exist
+    def query(self, obj):
+
+        if "\n" in obj:
+            return None
+
+        with self.lock:
+            # Try twice: if the co-process died under us, restart it and ask again
+            for _attempt in range(2):
+                if not self.process or self.process.poll() is not None:
+                    self.close()
+                    self.start()
+                try:
+                    return self._query(obj)
+                except (IOError, OSError, ValueError):
+                    self.close(kill = True)
+
+        raise GitError("git cat-file %s failed for %s" % (self.batch, obj), errno = errno.EPIPE)
+
+# ==================================================================================
+# Collapses concurrent and repeated fetches of the same repo, remote and refspec
+# into one real fetch. Whoever comes first runs the fetch, everybody asking for
+# the same fetch meanwhile waits for it and gets its output (or its exception).
+# A fetch that completed less than 'freshness' seconds ago is not repeated.
+# A fetch may also cover other fetches, e.g. "fetch -t" brings everything
+# plain "fetch" does.
+# Examples:
+#  fetches = FetchCoordinator(freshness = 30)
+#  fetches.fetch("/path/to/repo origin", lambda: git.run("fetch origin"))
+
+class FetchFlight:
+
+    def __init__(self):
+
+        self.done = threading.Event()
+        self.output = None
+        self.error = None
+
+class FetchCoordinator:
+
+    def __init__(self, freshness = 0):
+
+        self.freshness = freshness
+        self.lock = threading.Lock()
+        # key -> FetchFlight of the fetch running now
+        self.in_flight = {}
+        # key -> time the last successful fetch started
+        self.fetched = {}
+
+    def is_fresh(self, key):
+
+        started = self.fetched.get(key)
+        return started is not None and time.time() - started < self.freshness
+
+    # Forget about past fetches (of the given key), the next fetch will be a real one
+    def invalidate(self, key = None):
+
+        with self.lock:
+            if key is None:
+                self.fetched.clear()
+            else:
+                self.fetched.pop(key, None)
+
+    def fetch(self, key, func, covers = ()):
+
+        with self.lock:
+            if self.is_fresh(key):
+                return ""
+
+            flight = self.in_flight.get(key)
+            if flight:
+                leader = False
+            else:
+                leader = True
+                flight = FetchFlight()
+                keys = [ each for each in (key,) + tuple(covers) if each == key or each not in self.in_flight ]
+                for each in keys:
+                    self.in_flight[each] = flight
+
+        if not leader:
+            flight.done.wait()
+            if flight.error:
+                raise flight.error
+            return flight.output
+
+        started = time.time()
+        try:
+            flight.output = func()
+        except BaseException, e:
+            # Interrupted (KeyboardInterrupt, SystemExit...) is failed too: the waiters
+            # must not go on as if the refs were fetched
+            if isinstance(e, Exception):
+                flight.error = e
+            else:
+                flight.error = GitError("Fetch of %s interrupted: %r" % (key, e), errno = errno.EINTR)
+            raise
+        finally:
+            with self.lock:
+                for each in keys:
+                    if self.in_flight.get(each) is flight:
+                        del self.in_flight[each]
+                if not flight.error:
+                    for each in (key,) + tuple(covers):
+                        self.fetched[each] = started
+            flight.done.set()
+
+        return flight.output
+
+# ==================================================================================
+# Collects the pushes of create_branch(), tag_repo() and delete_branch() (or any
+# refspec given to add()) and sends them in one "git push --atomic" per remote,
+# so either all of the refs are updated or none of them is. Once pushed, 'results'
+# has the outcome for every ref, as "git push --porcelain" reports it.
+# Examples:
+#  with git.push_transaction() as transaction:
+#      git.create_branch("release-1.2")
+#      git.tag_repo("v1.2")
+#      git.delete_branch("staging-1.2")
+#  transaction.results  ->  {'refs/heads/release-1.2': PushResult(flag='*', summary='[new branch]'), ...}
+
+PushResult = namedtuple("PushResult", "flag summary")
+
+class PushTransaction:
+
+    def __init__(self, git, atomic = True):
+
+        self.git = git
+        self.atomic = atomic
+        # Remotes in the order they were first pushed to, remote -> refspecs
+        self.remotes = []
+        self.refspecs = {}
+        # Full ref name -> PushResult
+        self.results = {}
+        # The transaction we're nested in, if any
+        self.previous = None
+
+    def add(self, remote, refspec):
+
+        if remote not in self.refspecs:
+            self.remotes.append(remote)
+        self.refspecs.setdefault(remote, []).append(refspec)
+
+    def __enter__(self):
+
+        self.previous, self.git.transaction = self.git.transaction, self
+        return self
+
+    # Nothing is pushed if the block raised
+    def __exit__(self, ex_type, ex_value, trace):
+
+        self.git.transaction = self.previous
+        if ex_type is None:
+            self.push()
+        return False
+
+    def push(self):
+
+        remotes, self.remotes, refspecs, self.refspecs = self.remotes, [], self.refspecs, {}
+
+        atomic_arg = "--atomic" if self.atomic else ""
+        for remote in remotes:
+            try:
+                output = self.git.push("%s --porcelain %s %s" % (atomic_arg, remote, " ".join(refspecs[remote])))
+            except GitError, e:
+                self.parse(e.ex_info)
+                raise
+            finally:
+                self.git.forget_remote_refs(remote)
+            self.parse(output)
+
+        return self.results
+
+    def parse(self, output):
+
+        # Lines look like this (flags are described in "git help push"):
+        # *\trefs/heads/release-1.2:refs/heads/release-1.2\t[new branch]
+        # -\t:refs/heads/staging-1.2\t[deleted]
+        # !\trefs/tags/v1.2:refs/tags/v1.2\t[rejected] (atomic push failed)
+        for line in output.splitlines():
+            fields = line.split("\t")
+            if len(fields) == 3 and len(fields[0]) == 1:
+                self.results[fields[1].split(":")[-1]] = PushResult(fields[0], fields[2])
+
 # ==================================================================================
 # Examples:
 #  git = Git("/path/to/repo")
@@ -30,7 +314,9 @@ class GitError(utils.RunError):
 
 class Git:
 
-    def __init__(self, path='.', remote_repo = None, verbose = False, raise_exception = True):
+    def __init__(self, path='.', remote_repo = None, verbose = False, raise_exception = True,
+                 cat_file_batch = False, fetch_freshness = 0, fetch_coordinator = None,
+                 ref_cache = None, ls_remote_ttl = 0, ls_remote_cache = None):
 
         self.remote_repo = remote_repo
         self.path = path
@@ -38,6 +324,29 @@ class Git:
         self.verbose = verbose
         self.raise_exception = raise_exception
         self.errno = 0
+        # Keep "git cat-file" co-processes alive between object queries
+        self.cat_file_batch = cat_file_batch
+        self.cat_files = {}
+        # Ref snapshot, rebuilt whenever the refs on disk change,
+        # may be shared between Git objects of the same repo
+        self.common_dir = None
+        self.ref_cache = ref_cache or refs.RefCache()
+        # (ref snapshot, reach.ReachabilityIndex of the remote branches, up to date with it)
+        self.reach_index = (None, None)
+        # PushTransaction we're in, if any
+        self.transaction = None
+        # pubtags.PubTagIndex, kept in the git dir
+        self.pub_tags = None
+        # ref prefix -> versions.VersionIndex
+        self.version_indexes = {}
+        # Reads HEAD, refs and config straight from the files, when it can
+        self.files = None
+        # Fetch coordinator, may be shared between Git objects (fetches are keyed by repo)
+        self.fetches = fetch_coordinator or FetchCoordinator(fetch_freshness)
+        # On-disk cache of remote ref advertisements, None to always ask the remote
+        self.ls_remote_cache = ls_remote_cache
+        if not ls_remote_cache and ls_remote_ttl:
+            self.ls_remote_cache = lsremote.LsRemoteCache(ls_remote_ttl)
 
     # All git commands (unless overloaded) should just appear as methods here
     def __getattr__(self, name):
@@ -61,6 +370,135 @@ class Git:
 
         return output
 
+    # Stop the cat-file co-processes, they are restarted on the next query
+    def close(self):
+
+        for cat_file in self.cat_files.values():
+            cat_file.close()
+        self.cat_files = {}
+
+    def _cat_file_queries(self, batch, objs):
+
+        if not self.cat_file_batch:
+            # One cat-file for this bunch of queries only
+            cat_file = CatFile(self.path, batch)
+            try:
+                return [ cat_file.query(obj) for obj in objs ]
+            finally:
+                cat_file.close()
+
+        cat_file = self.cat_files.get(batch)
+        if not cat_file:
+            cat_file = self.cat_files.setdefault(batch, CatFile(self.path, batch))
+
+        return [ cat_file.query(obj) for obj in objs ]
+
+    def _cat_file_query(self, batch, obj):
+
+        return self._cat_file_queries(batch, [ obj ])[0]
+
+    # Returns (sha, type, size) of the given object or None if there is no such object
+    def object_info(self, obj):
+
+        return self._cat_file_query("--batch-check", obj)
+
+    # object_info() for a list of objects, all through one cat-file
+    def object_infos(self, objs):
+
+        return self._cat_file_queries("--batch-check", objs)
+
+    # Returns the raw contents of the given object or None if there is no such object
+    def object_contents(self, obj):
+
+        output = self._cat_file_query("--batch", obj)
+        if output:
+            return output[2]
+
+    def object_exists(self, obj):
+
+        return self.object_info(obj) is not None
+
+    def git_files(self):
+
+        # Look for the git directory again until we find it (e.g. we may be cloning)
+        if not self.files or not self.files.git_dir:
+            self.files = gitfiles.GitFiles(self.path)
+        return self.files
+
+    def git_common_dir(self):
+
+        if not self.common_dir:
+            self.common_dir = os.path.join(self.path, self.rev_parse("--git-common-dir", verbose = False))
+        return self.common_dir
+
+    # Returns a refs.RefSnapshot of all the refs in the repo, reusing the last one
+    # if neither packed-refs nor the loose refs have changed since
+    def ref_snapshot(self):
+
+        return self.ref_cache.get(self.git_common_dir(),
+                                  lambda: self.for_each_ref("--format='%s'" % refs.FOR_EACH_REF_FORMAT, verbose = False))
+
+    # Returns a reach.ReachabilityIndex of the remote branches. Only remote branches
+    # moving changes it, and then only the commits new to it are walked.
+    def reachability_index(self):
+
+        snapshot = self.ref_snapshot()
+        index = self.reach_index[1]
+        if self.reach_index[0] is snapshot:
+            return index
+
+        # Remote HEADs are symbolic refs, not branches
+        tips = tuple((name, sha) for name, sha in snapshot.refs("refs/remotes/") if not name.endswith("/HEAD"))
+        if index is None or index.tips != tips:
+            index = index or reach.ReachabilityIndex()
+            missing = index.missing(tips)
+            if missing and index.walked:
+                # What's new since the last tips, there may be any number of both
+                index.extend(self.walk_commits("--topo-order --reverse", revisions =
+                                               missing + [ "^%s" % sha for sha in sorted(index.walked) ]))
+            elif missing:
+                index.extend(self.walk_commits("--topo-order --reverse --remotes"))
+            index.set_tips(tips)
+
+        self.reach_index = (snapshot, index)
+        return index
+
+    # Returns the versions.VersionIndex of the v/<branch>/ refs of the remote
+    # (of all v/ refs if there is no branch), up to date with the refs
+    def version_index(self, branch = None, remote = None):
+
+        ref_remotes_pattern = "refs/remotes/%s/" % (remote or self.get_remote())
+        branch_pattern = "%s/" % branch if branch else ""
+        prefix = "%sv/%s" % (ref_remotes_pattern, branch_pattern)
+
+        index = self.version_indexes.get(prefix)
+        if index is None:
+            index = self.version_indexes.setdefault(prefix, versions.VersionIndex(prefix, ref_remotes_pattern))
+
+        index.update(self.ref_snapshot())
+        return index
+
+    # Returns the pubtags.PubTagIndex of the repo, up to date with its tags
+    def pub_tag_index(self):
+
+        if self.pub_tags is None:
+            self.pub_tags = pubtags.PubTagIndex(os.path.join(self.git_common_dir(), "pub-tags-index"))
+
+        self.pub_tags.update(self.ref_snapshot(), self.walk_commits)
+        return self.pub_tags
+
+    # Full names of the remote branches containing each of the given revisions,
+    # all in one go. Returns revision -> list of names, None if there is no such revision
+    def branches_containing(self, revisions):
+
+        revisions = list(revisions)
+        infos = self.object_infos([ "%s^{commit}" % revision for revision in revisions ])
+        shas = [ info[0] if info else None for info in infos ]
+
+        found = self.reachability_index().containing([ sha for sha in shas if sha ])
+
+        return dict((revision, found[sha] if sha else None) for revision, sha in zip(revisions, shas))
+
     def clone(self, repository, bare = False, upstream_branch = None, **kwargs):
 
         kwargs['cwd'] = kwargs.get('cwd', ".")
@@ -82,6 +520,10 @@ class Git:
         if not rev_parse:
             return True
 
+        # A checkout or a bare repo we can see without asking git
+        if self.git_files().git_dir:
+            return True
+
         # See if there is a .git directory here
         if self.run("rev-parse --is-inside-work-tree", verbose = False, raise_exception = False) == "true":
             # Working git directory
@@ -100,27 +542,43 @@ class Git:
             return
 
         if remote:
-            self.push("%s :refs/heads/%s" % (remote, branch_name))
+            self.push_ref(remote, ":refs/heads/%s" % branch_name)
         else:
             self.branch("-d %s" % branch_name)
 
     def branch_exists(self, branch_name, remote = "origin"):
 
         if remote:
-            branch_name = "remotes/%s/%s" % (remote, branch_name)
+            ref = "refs/remotes/%s/%s" % (remote, branch_name)
+        else:
+            ref = "refs/heads/%s" % branch_name
 
         try:
-            self.show_branch(branch_name, verbose = False)
-            return True
-       except GitError:
+            return self.ref_snapshot().get(ref) is not None
+        except GitError:
             return False
 
+    # Fetches go through the fetch coordinator: a fetch that is already running,
+    # or was done within the freshness window, is not repeated
+    def fetch(self, *args, **kwargs):
+
+        # Worktrees of one repo share its refs, fetching in one of them is enough
+        repo = os.path.realpath(self.git_common_dir())
+        words = " ".join(args).split()
+        key = "%s %s" % (repo, " ".join(words))
+
+        # Fetching tags brings everything a plain fetch does
+        covers = ()
+        if "-t" in words or "--tags" in words:
+            covers = ("%s %s" % (repo, " ".join(each for each in words if each not in ("-t", "--tags"))),)
+
+        return self.fetches.fetch(key, lambda: self.run("fetch %s" % " ".join(words), **kwargs), covers)
+
     def path_exists(self, path, branch = None, fetch = False):
 
         try:
             revision = self.latest_revision (upstream_branch = branch, fetch = fetch)
-            self.cat_file("-e %s:%s" % (revision, path), verbose = False)
-            return True
+            return self.object_exists("%s:%s" % (revision, path))
 
         except GitError:
             return False
@@ -128,6 +586,11 @@ class Git:
     def get_remote(self, index = 0):
 
         topic_branch = self.topic_branch()
+
+        remotes = self.git_files().config_values("branch", topic_branch, "remote")
+        if remotes:
+            return remotes[index]
+
         return self.config('--get-all branch.%s.remote' % topic_branch).rsplit()[index].rstrip()
 
     # Overload defautl ls-remote with one that swallows stderror
@@ -136,6 +599,58 @@ class Git:
         kwargs['stderr'] = open(os.devnull, 'w')
         return self.run("ls-remote %s" % ("".join(args)), **kwargs)
 
+    # URL of the given remote (remote name, URL or path), the ls-remote cache key
+    def remote_url(self, remote):
+
+        urls = self.git_files().config_values("remote", remote, "url")
+        if urls:
+            url = urls[-1]
+        elif "/" in remote or ":" in remote:
+            # A URL or a path already
+            url = remote
+        else:
+            url = self.ls_remote("--get-url %s" % remote, verbose = False)
+
+        # Relative paths only make sense from here
+        if os.path.isdir(os.path.join(self.path, url)):
+            url = os.path.realpath(os.path.join(self.path, url))
+
+        return url
+
+    # RefSnapshot of the refs advertised by the remote. With an ls-remote cache
+    # this is everything the remote has, and may come from the cache; without,
+    # it's whatever "git ls-remote <options> <remote> <patterns>" says.
+    def remote_refs(self, remote, options = "", patterns = ""):
+
+        if self.ls_remote_cache:
+            url = self.remote_url(remote)
+            return self.ls_remote_cache.get(url, lambda: self.ls_remote(url, verbose = False))
+
+        output = self.ls_remote("%s %s %s" % (options, remote, patterns), verbose = False)
+        return refs.RefSnapshot(lsremote.ls_remote_to_refs(output))
+
+    # Pushes refspec to the remote, or leaves it to the push transaction we're in
+    def push_ref(self, remote, refspec):
+
+        if self.transaction:
+            self.transaction.add(remote, refspec)
+            return
+
+        try:
+            self.push("%s %s" % (remote, refspec))
+        finally:
+            self.forget_remote_refs(remote)
+
+    def push_transaction(self, atomic = True):
+
+        return PushTransaction(self, atomic)
+
+    # After pushing to a remote, what the ls-remote cache has of it is stale
+    def forget_remote_refs(self, remote):
+
+        if self.ls_remote_cache:
+            self.ls_remote_cache.invalidate(self.remote_url(remote))
+
     # Create a branch locally, push it to the default remote and set it as upstream.
     def create_branch(self, branch, force = False, push = True, set_as_upstream = False):
 
@@ -146,7 +661,7 @@ class Git:
 
         if push:
             logging.debug("Creating branch %s in %s", branch, remote)
-            self.push("%s %s:%s" % (remote, branch, branch))
+            self.push_ref(remote, "%s:%s" % (branch, branch))
         else:
             logging.debug("Skip pushing branch %s to %s", branch, remote)
 
@@ -158,16 +673,22 @@ class Git:
 
         self.tag("%s %s" % (tag, args))
         if push:
-            self.push("%s %s" % (self.remote(), tag))
+            self.push_ref(self.remote(), tag)
 
     def topic_branch(self, try_rebase_merge_dir = False):
 
-        branch = self.rev_parse("--abbrev-ref HEAD")
+        files = self.git_files()
+
+        branch = files.abbrev_head() or self.rev_parse("--abbrev-ref HEAD")
 
         if branch != "HEAD":
             return branch
 
         if try_rebase_merge_dir:
+            head_name = files.rebase_head_name()
+            if head_name:
+                return head_name.replace("refs/heads/","")
+
             rebase_merge_dir = os.path.join(self.path, ".git", "rebase-merge")
             if os.path.isdir(rebase_merge_dir):
                 head_name_file = os.path.join(rebase_merge_dir, "head-name")
@@ -184,12 +705,23 @@ class Git:
 
     def current_revision(self, ref = 'HEAD'):
 
+        # Full ref names we can resolve ourselves, the rest is up to git
+        if ref == 'HEAD' or ref.startswith("refs/"):
+            sha = self.git_files().resolve(ref)
+            if sha:
+                return sha
+
         return self.rev_parse(ref)
 
     def upstream_branch(self, branch = None):
 
         topic_branch = branch or self.topic_branch()
-       try:
+
+        merges = self.git_files().config_values("branch", topic_branch, "merge")
+        if merges:
+            return merges[-1].replace("refs/heads/","")
+
+        try:
             upstream_branch = self.config("branch.%s.merge" % topic_branch)
 
         except GitError:
@@ -203,18 +735,19 @@ class Git:
         if fetch:
             self.fetch()
 
-        # The output of ls-remote looks like this:
-        # 46dba5752ea0308cc204c3ddbf0cb04b3fe6f809        refs/tags/master/pub-20141207.2
-        # 21415606422f14de340c9978f56a8cf18ffd356e        refs/tags/devel/pub-20141210.3
-        # ...
         try:
-            output = self.ls_remote("%s refs/tags/*" % (self.remote_repo or '.'), verbose = False)
+            if self.remote_repo:
+                snapshot = self.remote_refs(self.remote_repo, "--tags")
+            else:
+                # Our own tags are in the ref snapshot
+                snapshot = self.ref_snapshot()
 
-            # We need the right part of the right column (after refs/tags)
-            tags = map(lambda s: s.split('\t')[1].split("refs/tags/")[1], output.split('\n'))
+            tags = [ name[len("refs/tags/"):] for name in snapshot.names("refs/tags/") ]
 
             if regex:
-                return filter(lambda s:re.match(regex, s), tags)
+                # Compiled once for all the tags (or passed in compiled already)
+                regex = re.compile(regex)
+                return [ tag for tag in tags if regex.match(tag) ]
             else:
                 return tags
 
@@ -260,12 +793,18 @@ class Git:
         if fetch:
             self.fetch(remote)
 
-        output = self.ls_remote("%s --heads %s %s" % (self.remote_repo or '', remote, pattern))
-        if not output:
+        snapshot = self.remote_refs(self.remote_repo or remote, "--heads", pattern)
+        heads = snapshot.names("refs/heads/")
+
+        # ls-remote patterns match the end of the ref name, at a "/"
+        if pattern:
+            patterns = [ re.compile(fnmatch.translate("*/%s" % each)) for each in pattern.split() ]
+            heads = [ head for head in heads if any(each.match("/" + head) for each in patterns) ]
+
+        if not heads:
             return None
 
-        # We need the right part of the right column (after refs/heads)
-        return map(lambda s: s.split('\t')[1].split("refs/heads/")[1], output.split('\n'))
+        return [ head[len("refs/heads/"):] for head in heads ]
 
     def real_branches(self, remote = None, fetch = True):
 
@@ -275,29 +814,22 @@ class Git:
         if fetch:
             self.fetch(remote)
 
-        output = self.branch("--remote --list \"%s/*\" --no-color" % remote)
-        if not output:
+        # Remote branches will look like this:
+        #   refs/remotes/origin/HEAD
+        #   refs/remotes/origin/FOO_BRANCH
+        #   refs/remotes/origin/master
+        #   refs/remotes/origin/pub-20150206.6
+        #   refs/remotes/origin/v/master/0.0.444
+        prefix = "refs/remotes/%s/" % remote
+        branch_names = [ name[len(prefix):] for name in self.ref_snapshot().names(prefix) ]
+        if not branch_names:
             return None
 
-        # Output will look like this:
-        #   HEAD -> origin/master
-        #   origin/FOO_BRANCH
-        #   origin/pub-20150206.6
-        #   origin/v/master/0.0.444
-
-        # Now make a list of branch names: remove extra spaces, dereferences
-        # and remote name from the path. The list from above becomes:
-        # master
+        # remove HEAD and special branches, in example above leave only:
         # FOO_BRANCH
-        # pub-20150206.6
-        # v/master/0.0.444
-        branch_names = map(lambda s: re.sub(".*-> ", "", s.split("  ")[1]).split("%s/" % remote)[1], output.split('\n'))
-
-        # remove special branches, in example above leave only:
         # master
-        # FOO_BRANCH
-        regex = re.compile("^v/.*|^pub-\d+\.\d+$|^build-\d+\.\d+$")
-        real_branches = filter(lambda each:not re.match(regex, each), branch_names) + ['master']
+        real_branches = [ each for each in branch_names
+                          if each != "HEAD" and not SPECIAL_BRANCHES.match(each) ] + ['master']
 
         return list(set(real_branches))
 
@@ -305,28 +837,27 @@ class Git:
     def branches_with_revision(self, revision, pattern = '', strip_remote = True):
 
         try:
-            output = self.branch("--contains %s --all --list --no-color" % revision, verbose = False)
+            names = self.branches_containing([ revision ])[revision]
         except GitError:
             return []
 
-        # Output will look like this:
-        # * somebranch
-        #    master
-        #    remotes/origin/HEAD -> origin/master
-        #    remotes/origin/master
-        # We need to remove two first character, take only remote branches and trim everything
-        # but the branch name
+        if not names:
+            return []
+
+        # Names will look like this:
+        #    refs/remotes/origin/master
+        #    refs/remotes/origin/v/master/0.0.444
+        # Take only the branches of our remote, and trim everything but the branch name
         remote_str = "remotes/%s/" % self.get_remote()
-        regex = re.compile("%s%s[^\s]*$" % (remote_str, pattern)) # take lines with no whitespace
-        branches = filter(lambda each:re.match(regex, each), map(lambda each:each[2:], output.splitlines()))
+        regex = re.compile("%s%s[^\s]*$" % (remote_str, pattern)) # take names with no whitespace
+        branches = filter(lambda each:re.match(regex, each), map(lambda each:each[len("refs/"):], names))
         return map(lambda each:each.replace(remote_str,'') if strip_remote else each, branches)
 
 
     def commit_is_merged(self, revision):
 
         try:
-            output = self.branch("--contains %s --remote --list --no-color" % revision, verbose = False)
-            if output:
+            if self.branches_containing([ revision ])[revision]:
                 # Commit is reachable in remote refs/heads
                 return True
             # Commit sits in refs/changes and not in refs/heads
@@ -337,31 +868,26 @@ class Git:
 
     def get_m_branch(self):
 
-        m_ref = "refs/remotes/m"
+        m_ref = "refs/remotes/m/"
         try:
-            output = self.ls_remote(". %s*" % m_ref)
-            if output:
-                return output.split()[1].replace("%s/" % m_ref, "", 1)
+            names = self.ref_snapshot().names(m_ref)
+            if names:
+                return names[0].replace(m_ref, "", 1)
         except GitError:
             pass
+
     def first_repo_revision(self, revision, branch = None):
 
         try:
-            ref_remotes_pattern = "refs/remotes/%s/" % self.get_remote()
-            branch_pattern = "%s/*" % branch if branch else "*"
-            pattern = "%sv/%s" % (ref_remotes_pattern, branch_pattern)
-
-            # git sorts alphanumerically, it will bring 0.0.10 before 0.0.9
-            # so we need all matching refs for ourselves to sort
-            output = self.for_each_ref("%s --points-at %s --format '%%(refname)'" % (pattern, revision))
-            # Output will look like this:
-            #
-            # refs/remotes/origin/v/master/0.0.10
-            # refs/remotes/origin/v/master/0.0.11
-            # refs/remotes/origin/v/master/0.0.9
-            if output:
-                revs = [ Revision(x.replace(ref_remotes_pattern, "")) for x in output.splitlines() ]
-                return revision_branch_name(min(revs))
+            info = self.object_info(revision)
+            if not info:
+                return None
+
+            # git sorts alphanumerically, it will bring 0.0.10 before 0.0.9,
+            # the version index has them in Revision order
+            revs = self.version_index(branch).at(info[0])
+            if revs:
+                return revision_branch_name(revs[0])
         except GitError:
             pass
 
@@ -378,59 +904,193 @@ class Git:
 
         # Get repo's default remote
         remote = self.get_remote()
-        ref_remotes_pattern = "refs/remotes/%s/" % remote
         remote_branch = "%s/%s" % (remote, branch)
 
+        try:
+            parent = self.merge_base("HEAD %s" % remote_branch)
+        except GitError:
+            return None
+
         # Go over all remote commits - from the tip all the way back to our parent
-        # and see if they point to a published revision
+        # (excluding the parent's parents, if there are any) and see if they point
+        # to a published revision. We stop walking as soon as we find one
         # (we could look deeper, but it is safer to stop somewhere...)
+        index = self.version_index(branch, remote)
+        commits = self.walk_commits("%s --not %s^@" % (remote_branch, parent))
         try:
-            parent = self.merge_base("HEAD %s" % remote_branch)
-            revisions = self.rev_list("%s~..%s" % (parent, remote_branch)).split()
+            for entry in commits:
+                revs = index.at(entry.sha)
+                if revs:
+                    # We just need the latest, largest number
+                    return revision_branch_name(revs[-1])
+                # else - go one revision earlier
         except GitError:
-            # Our parent is the only revision?
             pass
-        if not revisions:
-            revisions = [parent]
+        finally:
+            commits.close()
 
-        for revision in revisions:
-            try:
-                output = self.for_each_ref("%sv/%s/ --points-at %s --format '%%(refname)'" % (ref_remotes_pattern, branch, revision))
-                if output:
-                    # Output will look like this:
-                    #
-                    # refs/remotes/origin/v/master/0.0.10
-                    # refs/remotes/origin/v/master/0.0.11
-                    # refs/remotes/origin/v/master/0.0.9
-                    #
-                    # Now we just need the latest, largest number
-                    revs = [ Revision(x.replace(ref_remotes_pattern, "")) for x in output.splitlines() ]
-                    return revision_branch_name(max(revs))
-                # else - go one revision earlier
-            except GitError:
-                pass
+    '''
+    Walks the commits given by 'git log' arguments (e.g. "--first-parent A..B"),
+    yielding a CommitEntry for each commit as soon as git prints it:
 
-    def rev(self, revision = "HEAD", show_tag = False):
+    for entry in git.walk_commits("origin/master", decorate = True):
+        if "refs/tags/v1.0" in entry.refs:
+            break
+
+    Any number of revisions (and "^" exclusions) can be given in 'revisions',
+    they go through stdin rather than the command line.
+
+    Stopping early (break, or close() on the generator) kills git right away.
+    If git fails, GitError is raised once its output is exhausted.
+    '''
+    def walk_commits(self, args = "", decorate = False, revisions = None):
+
+        fmt = "--format=%H%x00%P%x00%D" if decorate else "--format=%H%x00%P%x00"
+
+        cmd = ["log", "--no-color", "--no-show-signature", "--decorate=full", fmt] + shlex.split(args)
+        input = None
+        if revisions is not None:
+            cmd.append("--stdin")
+            input = "".join("%s\n" % revision for revision in revisions)
+
+        # Whatever log.showSignature says, only our format is to be printed
+        lines = self.stream_lines(cmd, input)
+        try:
+            for line in lines:
+                sha, parents, decorations = line.rstrip("\n").split("\0")
+                refs = []
+                # Decorations look like this:
+                # HEAD -> refs/heads/master, tag: refs/tags/t1, refs/remotes/origin/master
+                for ref in decorations.split(", ") if decorations else []:
+                    ref = ref.split(" -> ")[-1]
+                    if ref.startswith("tag: "):
+                        ref = ref[len("tag: "):]
+                    refs.append(ref)
+                yield CommitEntry(sha, parents.split(), refs)
+        finally:
+            lines.close()
+
+    '''
+    Walks "git diff <args>" output (HEAD by default, i.e. uncommitted changes)
+    yielding a gitdiff.DiffEntry for each file as soon as git gets to it.
+    The hunks are only read if asked for:
+
+    for entry in git.walk_diff():
+        if entry.status == "A" and not entry.binary:
+            print entry.body()
+
+    Stopping early kills git right away, as for walk_commits().
+    '''
+    def walk_diff(self, args = "HEAD"):
+
+        cmd = ["diff", "--no-color", "--no-ext-diff", "--src-prefix=a/", "--dst-prefix=b/"] + shlex.split(args)
+        lines = self.stream_lines(cmd)
+        try:
+            for entry in gitdiff.iter_diff(lines):
+                yield entry
+        finally:
+            lines.close()
+
+    # Lines of "git <cmd>" output, with their '\n', as they come from the pipe.
+    # 'input' is written to git's stdin first (e.g. revisions for --stdin)
+    def stream_lines(self, cmd, input = None):
+
+        cmd = ["git"] + cmd
 
+        if self.verbose:
+            logging.info("Running command '%s', cwd '%s'", " ".join(cmd), self.path)
+
+        utils.notify_pre_run(cmd, self.path)
+        # Our caller is up the stack only now: by the time git is done, the stack
+        # is whoever's iterating over the output
+        method = utils.calling_git_method() if utils.post_run_hooks else None
+        start = time.time()
+        size = 0
+
+        stderr = TemporaryFile()
+        process = subprocess.Popen(cmd, cwd = self.path, stdout = subprocess.PIPE, stderr = stderr,
+                                   stdin = subprocess.PIPE if input is not None else None)
         try:
-            output = self.show_ref("--abbrev %s" % revision, verbose = False)
-            # Revision is a tag or a branch
-            if show_tag:
-                return output
-            # Get to the actual commit, revision will be a hash
+            if input is not None:
+                # git reads all of it before it starts writing
+                try:
+                    process.stdin.write(input)
+                except IOError:
+                    # git gave up early, what it says about it is in stderr
+                    pass
+                process.stdin.close()
+
+            for line in process.stdout:
+                size += len(line)
+                yield line
+
+            if process.wait():
+                stderr.seek(0)
+                raise GitError(stderr.read().rstrip(), errno = process.returncode, cmd = " ".join(cmd))
+
+        finally:
+            errno = process.poll()
+            if errno is None:
+                # The consumer stopped early
+                process.kill()
+                errno = 0
+            process.stdout.close()
+            process.wait()
+            stderr.close()
+            utils.notify_post_run(cmd, self.path, start, errno, size, method)
+
+    def rev(self, revision = "HEAD", show_tag = False):
+
+        if show_tag:
             try:
-                revision = self.rev_list("-1 %s" % revision, verbose = False)
+                # Revision is a tag or a branch
+                return self.show_ref("--abbrev %s" % revision, verbose = False)
             except GitError:
-                return None
-        except:
-            pass
+                pass
 
-        # Revision is a hash, return its short form
-        try:
-            return self.rev_parse("--short %s" % revision, verbose = False)
+        return self.rev_many([ revision ])[revision]
 
-        except GitError:
-            return None
+    '''
+    Resolves a bunch of revisions to short hashes with one cat-file and one git log
+    (per thousand commits), returns a dict like:
+    {'origin/master': '7767d28', 'v/master/pub-20160227.2': '7767d28', 'no-such-branch': None}
+    Tags and branches resolve to the commit they point at.
+    '''
+    def rev_many(self, revisions):
+
+        revisions = list(revisions)
+
+        # Ask for the commit first and, for things that are not commits, the object itself
+        queries = []
+        for revision in revisions:
+            queries += [ "%s^{commit}" % revision, revision ]
+        infos = self.object_infos(queries)
+
+        shas = {}
+        commits = set()
+        for index, revision in enumerate(revisions):
+            info = infos[2 * index] or infos[2 * index + 1]
+            shas[revision] = info[0] if info else None
+            if info and info[1] == "commit":
+                commits.add(info[0])
+
+        # Let git pick the abbreviation length. "rev-parse --short" takes one object
+        # only, "log --no-walk" takes many, but commits only
+        short_shas = {}
+        commits = sorted(commits)
+        for start in range(0, len(commits), 1000):
+            output = self.log("--no-walk=unsorted --no-show-signature --format='%%H %%h' %s" %
+                              " ".join(commits[start:start + 1000]), verbose = False)
+            short_shas.update(line.split() for line in output.splitlines())
+
+        for sha in set(shas.values()):
+            if sha and sha not in short_shas:
+                try:
+                    short_shas[sha] = self.rev_parse("--short %s" % sha, verbose = False)
+                except GitError:
+                    pass
+
+        return dict((revision, short_shas.get(sha)) for revision, sha in shas.items())
 
     '''
     Dumps out something like:
@@ -443,7 +1103,9 @@ class Git:
 
         output = ""
 
-        abbrev_revision = self.rev_parse(" --short %s" % self.rev_list("-1 %s" % revision))
+        abbrev_revision = self.rev_many([ revision ])[revision]
+        if not abbrev_revision:
+            raise GitError("Unknown revision %s" % revision, errno = errno.ENOENT)
 
         for tag in reversed(self.tag(" --points-at %s" % abbrev_revision).split('\n')):
             output += "%s " % tag
@@ -461,23 +1123,86 @@ class Git:
         if not revision:
             revision = self.current_revision()
 
-        pub_tags = self.tag("-l --contains %s v/*/pub-*" % self.rev(revision))
-        if pub_tags:
-            return pub_tags.split('\n')[0]
+        info = self.object_info("%s^{commit}" % revision)
+        if not info:
+            raise GitError("Unknown revision %s" % revision, errno = errno.ENOENT)
+
+        return self.pub_tag_index().first_containing(info[0])
 
     def uncommitted_changes(self):
+
+        lines = []
         try:
-            return self.diff ("HEAD", verbose = False).splitlines()
+            for entry in self.walk_diff("HEAD"):
+                for line in entry.header:
+                    lines.extend(line.splitlines())
+                for line in entry.lines():
+                    lines.extend(line.splitlines())
 
         except GitError:
             return None
 
+        # Just as if it were run() output, which loses the trailing whitespace
+        while lines and not lines[-1].strip():
+            lines.pop()
+        if lines:
+            lines[-1] = lines[-1].rstrip()
+
+        return lines
+
+    # Are there uncommitted changes? git stops looking at the first one.
+    # None if we can't tell (e.g. no HEAD yet)
+    def has_uncommitted_changes(self):
+
+        try:
+            self.diff("--quiet HEAD", verbose = False)
+            return False
+
+        except GitError, e:
+            if e.errno == 1:
+                return True
+            return None
+
+    # Above this many paths, status looks at the whole tree rather than at a pathspec each
+    STATUS_PATHSPEC_LIMIT = 1000
+
+    '''
+    State of the index and the work tree from a single "git status", as a
+    gitstatus.StatusSnapshot - of the given paths only, or of all of them if None.
+    Untracked files are only looked for if asked for, which is the slow part.
+
+    snapshot = git.status_snapshot()
+    snapshot.is_dirty("lib/foo.c")      ->  True
+    snapshot.index_state("lib/foo.c")   ->  'M'
+    snapshot.renamed_from("lib/new.c")  ->  'lib/old.c'
+    '''
+    def status_snapshot(self, paths = None, untracked = False):
+
+        # A poll, it doesn't get to take the index lock (for refreshing it) from whoever needs it
+        cmd = ["--no-optional-locks", "status", "--porcelain=v2", "-z",
+               "--untracked-files=%s" % ("all" if untracked else "no")]
+        if paths is not None and len(paths) <= self.STATUS_PATHSPEC_LIMIT:
+            if not paths:
+                return gitstatus.StatusSnapshot("")
+            # Paths, not patterns: "foo[1].c" is just that
+            cmd += ["--"] + [ ":(literal)%s" % path for path in paths ]
+
+        # Taken as it comes, run() would mangle paths with spaces and NULs
+        return gitstatus.StatusSnapshot("".join(self.stream_lines(cmd)))
+
+    # Which of the given paths (all of them if None) are dirty, as file_is_dirty() tells,
+    # in the given order
+    def dirty_files(self, paths = None):
+
+        return self.status_snapshot(paths).dirty(paths)
+
     def committed_changes(self, reverse = True, fetch = False):
 
         reverse_arg = "--reverse" if reverse else ""
-        output = self.rev_list("--first-parent %s %s..HEAD" % (reverse_arg, self.latest_revision(fetch = fetch)))
-        if output:
-            return output.splitlines()
+        commits = [ entry.sha for entry in
+                    self.walk_commits("--first-parent %s %s..HEAD" % (reverse_arg, self.latest_revision(fetch = fetch))) ]
+        if commits:
+            return commits
         return None
 
     def get_parent(self, upstream_branch = None, revision = None, fetch = False):
@@ -507,43 +1232,143 @@ class Git:
         self.config("--add remote.%s.fetch +refs/notes/*:refs/notes/*" % remote)
         self.config("--add remote.%s.fetch +refs/jnpr/*:refs/jnpr/*" % remote)
 
-    def extract_path(self, extract_path, stdout = None):
+    # Rewrites the whole repo (all refs and tags) to hold the history of one directory only.
+    # engine is "filter-branch" (git filter-branch --subdirectory-filter) or "fast-export",
+    # which streams git fast-export through fastexport.PathExtractor into git fast-import
+    # and returns its stats
+    def extract_path(self, extract_path, stdout = None, engine = "filter-branch"):
+
+        if engine == "fast-export":
+            return self.extract_path_fast_export(extract_path, stdout)
 
         logging.info("Extracting %s, this can take a while", extract_path)
 
-        output = self.filter_branch("--tag-name-filter cat --subdirectory-filter %s -- --all" % extract_path, stdout = stdout)
+        # Dangling references appear in output as:
+        # "WARNING: Ref 'refs/tags/v0.0.91' is unchanged"
+        start_marker = "WARNING: Ref '"
+        end_marker = "' is unchanged"
+        unchanged_refs = []
 
-        if output:
-            # Remove dangling references, they appear in output as:
-            # "WARNING: Ref 'refs/tags/v0.0.91' is unchanged"
-            start_marker = "WARNING: Ref '"
-            end_marker = "' is unchanged"
+        def find_unchanged_ref(line):
+            line = line.rstrip("\n")
+            if line.startswith(start_marker) and line.endswith(end_marker):
+                unchanged_refs.append(line.replace(start_marker, "").replace(end_marker, ""))
+
+        # When streaming, print the output as it comes and keep only its tail
+        sinks = [ utils.EchoSink(), utils.TailSink(), find_unchanged_ref ]
+
+        output = self.filter_branch("--tag-name-filter cat --subdirectory-filter %s -- --all" % extract_path,
+                                    stdout = stdout, sinks = sinks)
+        if stdout != subprocess.PIPE:
             for line in output.split("\n"):
-                if line.startswith(start_marker) and line.endswith(end_marker):
-                    ref = line.replace(start_marker, "").replace(end_marker, "")
-                    # If we remove the reference that tracks remote HEAD,
-                    # we won't be able to gc or repack later, so leave it alone
-                    remote_head_ref = "refs/remotes/%s/%s" % (self.get_remote(), self.topic_branch())
-                    logging.debug("Will not remove %s", remote_head_ref)
-                    if ref != remote_head_ref:
-                        self.update_ref("-d %s" % ref)
+                find_unchanged_ref(line)
+
+        # Remove dangling references
+        for ref in unchanged_refs:
+            # If we remove the reference that tracks remote HEAD,
+            # we won't be able to gc or repack later, so leave it alone
+            remote_head_ref = "refs/remotes/%s/%s" % (self.get_remote(), self.topic_branch())
+            logging.debug("Will not remove %s", remote_head_ref)
+            if ref != remote_head_ref:
+                self.update_ref("-d %s" % ref)
 
         # Remove the namespace where the original commits are stored
         shutil.rmtree(self.path + "/.git/refs/original", ignore_errors = True)
 
-        # Remove reflog, prune garbage collection and repack
-        self.reflog("expire --verbose --expire=0 --all", stdout = stdout)
-        self.gc("--prune=0", stdout = stdout)
-        self.repack("-ad", stdout = stdout)
+        self.drop_old_history(stdout)
+
+    # Remove reflog, prune garbage collection and repack
+    def drop_old_history(self, stdout = None):
+
+        self.reflog("expire --verbose --expire=0 --all", stdout = stdout, sinks = [ utils.EchoSink(), utils.TailSink() ])
+        self.gc("--prune=0", stdout = stdout, sinks = [ utils.EchoSink(), utils.TailSink() ])
+        self.repack("-ad", stdout = stdout, sinks = [ utils.EchoSink(), utils.TailSink() ])
+
+    def extract_path_fast_export(self, extract_path, stdout = None):
+
+        logging.info("Extracting %s with fast-export", extract_path)
+
+        refs_before = [ name for name, _sha in self.ref_snapshot().refs("refs/") ]
+
+        # The ref tracking remote HEAD is kept (see below). It's looked up before anything
+        # is rewritten, and there is none to keep on a detached HEAD or without upstream
+        try:
+            remote_head_ref = "refs/remotes/%s/%s" % (self.get_remote(), self.topic_branch())
+        except (GitError, IndexError):
+            remote_head_ref = None
+
+        # fast-export does the history simplification: with the path given, it leaves
+        # out commits not touching it and moves refs to the nearest commit that does
+        export_cmd = [ "git", "fast-export", "--all", "--signed-tags=strip", "--tag-of-filtered-object=rewrite",
+                       "--reencode=no", "--", extract_path ]
+        import_cmd = [ "git", "fast-import", "--force", "--quiet" ]
+
+        extractor = fastexport.PathExtractor(extract_path)
+
+        start = time.time()
+        for cmd in (export_cmd, import_cmd):
+            utils.notify_pre_run(cmd, self.path)
+
+        export_errors = TemporaryFile()
+        import_errors = TemporaryFile()
+        exporter = subprocess.Popen(export_cmd, cwd = self.path, bufsize = -1,
+                                    stdout = subprocess.PIPE, stderr = export_errors)
+        importer = subprocess.Popen(import_cmd, cwd = self.path, bufsize = -1,
+                                    stdin = subprocess.PIPE, stderr = import_errors)
+        try:
+            try:
+                extractor.run(exporter.stdout, importer.stdin)
+            finally:
+                if exporter.poll() is None:
+                    exporter.kill()
+                exporter.stdout.close()
+                importer.stdin.close()
+
+            export_errno = exporter.wait()
+            import_errno = importer.wait()
+            utils.notify_post_run(export_cmd, self.path, start, export_errno, extractor.bytes)
+            utils.notify_post_run(import_cmd, self.path, start, import_errno, extractor.bytes)
+
+            for cmd, errno, errors in ((export_cmd, export_errno, export_errors),
+                                       (import_cmd, import_errno, import_errors)):
+                if errno:
+                    errors.seek(0)
+                    raise GitError(errors.read().rstrip(), errno = errno, cmd = " ".join(cmd))
+        finally:
+            if importer.poll() is None:
+                importer.kill()
+                importer.wait()
+            export_errors.close()
+            import_errors.close()
+
+        # Refs with nothing in the extracted directory are dropped, except for
+        # the one tracking remote HEAD (we won't be able to gc or repack without it)
+        # and symbolic refs (e.g. refs/remotes/origin/HEAD)
+        dropped = [ ref for ref in refs_before
+                    if ref not in extractor.refs and ref != remote_head_ref and not ref.endswith("/HEAD") ]
+        if dropped:
+            with TemporaryFile() as deletes:
+                deletes.write("".join("delete %s\n" % ref for ref in dropped))
+                deletes.seek(0)
+                self.update_ref("--no-deref --stdin", stdin = deletes)
+
+        # Bring the work tree (if there is one) to the new HEAD, as filter-branch does
+        if self.rev_parse("--is-bare-repository", verbose = False) != "true":
+            self.read_tree("-u -m HEAD")
+
+        self.drop_old_history(stdout)
+
+        stats = extractor.stats()
+        stats['dropped_refs'] = dropped
+        return stats
 
     def rebase_repo(self, upstream_branch = None, revision = None,
                     fetch = True, verbose = False, silent = False):
 
         log = logging.debug if silent else logging.info
 
-        # First, fetch heads and tags
+        # First, fetch heads and tags (fetching tags brings the heads too)
         if fetch:
-            self.fetch()
             self.fetch("-t")
 
         ''' Let's say we have:
@@ -608,11 +1433,11 @@ class Git:
                 log("Switch to branch %s", new_upstream_branch)
                 self.config("--replace-all branch.%s.merge %s" % (self.topic_branch(), new_upstream_branch))
 
+    # Added, copied, modified or renamed, in the index or in the work tree.
+    # For many files, dirty_files() or status_snapshot() tell in one go
     def file_is_dirty (self, fname):
 
-        diff_cmd = "--diff-filter=ACMR --name-only "
-        return self.diff(diff_cmd + fname) == fname or \
-               self.diff(diff_cmd + " --cached " + fname) == fname
+        return self.status_snapshot([ fname ]).is_dirty(fname)
 
 
     def merge_for_upload(self, *args, **kwargs):
@@ -642,6 +1467,11 @@ class Git:
         return authors
 
     def get_merge_head(self):
+
+        files = self.git_files()
+        if files.git_dir:
+            return files.merge_head()
+
         try:
             git_dir = self.rev_parse("--git-dir", verbose = False)
             with open(os.path.join(self.path, git_dir, "MERGE_HEAD"), "r") as fp:
@@ -666,7 +1496,7 @@ class Git:
         try:
             # We are going to parse some remote revisions, it's time to fetch
             upstream_commit = self.rev_parse(remote_branch)
-            return self.rev_list("%s..%s" % (base_revision, upstream_commit)).split()
+            return [ entry.sha for entry in self.walk_commits("%s..%s" % (base_revision, upstream_commit)) ]
         except GitError:
             # No such remote branch? No upstream gain for you!
             pass
@@ -685,22 +1515,23 @@ def get_git_directory(path = os.getcwd()):
         logging.warning("Failed git.rev-parse --show-toplevel in %s: %s", realpath, e)
         return None
 
-def update_gitattributes(path, pattern, attribute):
-
-    gitattributes = os.path.join(path, GITATTRIBUTES)
+# The .gitattributes of the repo at 'path' as a gitpatterns.AttributesFile, to add and
+# remove any number of rules and write the file once:
+#  with open_gitattributes(path) as attributes:
+#      for pattern, attribute in rules:
+#          attributes.add(pattern, attribute)
+def open_gitattributes(path):
 
-    with open(gitattributes, "a+") as fdesc:
+    return gitpatterns.AttributesFile(os.path.join(path, GITATTRIBUTES))
 
-        reg_pattern = "^%s\s+%s\s*$" % (pattern.replace("*","\*"), attribute)
-        reg = re.compile(reg_pattern)
+# Same for .gitignore, as a gitpatterns.IgnoreFile
+def open_gitignore(path):
 
-        fdesc.seek(0)
+    return gitpatterns.IgnoreFile(os.path.join(path, GITIGNORE))
 
-        for _idx, line in enumerate(fdesc):
-            for _match in re.finditer(reg, line):
-                return
+def update_gitattributes(path, pattern, attribute):
 
-        logging.debug("Updating %s", gitattributes)
-        fdesc.write("%s %s\n" % (pattern, attribute))
+    with open_gitattributes(path) as attributes:
+        attributes.add(pattern, attribute)
 
                                                                                             
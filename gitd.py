@@ -0,0 +1,459 @@
+#!/usr/bin/env python
+import os
+import sys
+import json
+import time
+import stat
+import errno
+import socket
+import struct
+import argparse
+import threading
+import subprocess
+
+# ==================================================================================
+# A daemon keeping Git objects (and their ref snapshots, cat-file co-processes,
+# version and reachability indexes...) warm between calls, and a thin client
+# forwarding Git method calls to it over a Unix socket.
+# The client side imports nothing but the standard library, so a scripted query
+# costs a connect and a round trip, not an interpreter full of imports and cold caches.
+# The client starts the daemon if it isn't running, the daemon exits after being
+# idle for a while.
+#
+# The protocol is one JSON object per line each way:
+#  -> {"repo": "/path/to/repo", "method": "current_revision", "args": [], "kwargs": {}}
+#  <- {"value": "46dba5752ea0308cc204c3ddbf0cb04b3fe6f809"}
+#  <- {"error": "fatal: ...", "errno": 128, "type": "GitError"}
+# and a few daemon commands: {"op": "ping"}, {"op": "invalidate", "repo": ...}, {"op": "stop"}
+# Examples:
+#  git = GitClient("/path/to/repo")
+#  git.current_revision()                 ->  u'46dba5752ea0308cc204c3ddbf0cb04b3fe6f809'
+#  git.remote_tags(r"v/master/pub-\d+", fetch = False)
+#  python gitd.py call /path/to/repo last_repo_revision master --kwargs '{"fetch": false}'
+#  python gitd.py invalidate /path/to/repo
+
+DEFAULT_IDLE_TIMEOUT = 600
+
+# Not in Python 2's socket module, 17 on Linux
+SO_PEERCRED = getattr(socket, "SO_PEERCRED", 17 if sys.platform.startswith("linux") else None)
+
+class GitdError(Exception):
+    def __init__(self, ex_info, errno = None, cmd = None, error_type = None):
+        self.ex_info = ex_info
+        self.errno = errno
+        self.cmd = cmd
+        self.error_type = error_type
+
+    def __str__(self):
+        return self.ex_info
+
+# The socket lives in a directory nobody else can write to: $XDG_RUNTIME_DIR, or a
+# directory of ours in /tmp. In /tmp itself anybody could create it first, and then
+# answer (or record) every call.
+def default_socket_path():
+
+    if os.environ.get("GITD_SOCKET"):
+        return os.environ["GITD_SOCKET"]
+
+    directory = os.environ.get("XDG_RUNTIME_DIR")
+    if not directory or not os.path.isdir(directory):
+        directory = "/tmp/gitd-%d" % os.getuid()
+        try:
+            os.mkdir(directory, 0700)
+        except OSError, e:
+            if e.errno != errno.EEXIST:
+                raise
+
+    check_private_directory(directory)
+    return os.path.join(directory, "gitd.sock")
+
+def check_private_directory(directory):
+
+    info = os.lstat(directory)
+    if not stat.S_ISDIR(info.st_mode) or info.st_uid != os.getuid() or info.st_mode & 0077:
+        raise GitdError("%s is not a private directory of uid %d" % (directory, os.getuid()), errno = errno.EPERM)
+
+# uid of the process at the other end of a Unix socket, None if we can't tell
+def peer_uid(connection):
+
+    if SO_PEERCRED is None:
+        return None
+
+    size = struct.calcsize("3i")
+    try:
+        _pid, uid, _gid = struct.unpack("3i", connection.getsockopt(socket.SOL_SOCKET, SO_PEERCRED, size))
+        return uid
+    except (socket.error, struct.error):
+        return None
+
+# Makes sure we're talking to a daemon of ours, before telling it anything
+def check_daemon(connection, socket_path):
+
+    uid = peer_uid(connection)
+    if uid is None:
+        # The socket's owner is the next best thing
+        try:
+            uid = os.stat(socket_path).st_uid
+        except OSError:
+            pass
+
+    if uid != os.getuid():
+        raise GitdError("%s is served by uid %s, not by uid %d" % (socket_path, uid, os.getuid()),
+                        errno = errno.EPERM)
+
+# json gives us unicode, git commands want str
+def decode_value(value):
+
+    if isinstance(value, unicode):
+        return value.encode("utf-8")
+    if isinstance(value, list):
+        return [ decode_value(each) for each in value ]
+    if isinstance(value, dict):
+        return dict((decode_value(key), decode_value(each)) for key, each in value.iteritems())
+    return value
+
+# Whatever json can't do (sets, Revision objects...) goes as a list or a string
+def encode_value(value):
+
+    if isinstance(value, (set, frozenset)):
+        return sorted(value)
+    return str(value)
+
+# ==================================================================================
+# Server
+
+class GitDaemon:
+
+    def __init__(self, socket_path = None, idle_timeout = DEFAULT_IDLE_TIMEOUT,
+                 fetch_freshness = 0, ls_remote_ttl = 0):
+
+        self.socket_path = socket_path or default_socket_path()
+        self.idle_timeout = idle_timeout
+        self.fetch_freshness = fetch_freshness
+        self.ls_remote_ttl = ls_remote_ttl
+
+        self.lock = threading.Lock()
+        # real path -> (Git, lock serializing the calls on it)
+        self.gits = {}
+        # All repos share a fetch coordinator and an ls-remote cache
+        self.fetches = None
+        self.ls_remote_cache = None
+        self.last_request = time.time()
+        self.requests = 0
+        self.in_flight = 0
+        self.stopped = threading.Event()
+
+    def git(self, repo):
+
+        # Imported here, the client side doesn't need any of it
+        import git
+        import lsremote
+
+        path = os.path.realpath(repo)
+        with self.lock:
+            if path not in self.gits:
+                if self.fetches is None:
+                    self.fetches = git.FetchCoordinator(self.fetch_freshness)
+                    self.ls_remote_cache = lsremote.LsRemoteCache(self.ls_remote_ttl) if self.ls_remote_ttl else None
+                self.gits[path] = (git.Git(path, cat_file_batch = True, fetch_coordinator = self.fetches,
+                                           ls_remote_cache = self.ls_remote_cache), threading.Lock())
+            return self.gits[path]
+
+    # Forget a repo's Git object and everything it has cached (all repos if repo is None)
+    def invalidate(self, repo = None):
+
+        with self.lock:
+            if repo is None:
+                paths = self.gits.keys()
+                if self.fetches:
+                    self.fetches.invalidate()
+            else:
+                paths = [ os.path.realpath(repo) ]
+            dropped = [ self.gits.pop(path) for path in paths if path in self.gits ]
+
+        for git, lock in dropped:
+            with lock:
+                git.close()
+
+        return len(dropped)
+
+    def handle(self, request):
+
+        op = request.get("op", "call")
+        if op == "ping":
+            return { 'value': { 'pid': os.getpid(), 'repos': sorted(self.gits), 'requests': self.requests } }
+        if op == "invalidate":
+            return { 'value': self.invalidate(request.get("repo")) }
+        if op == "stop":
+            self.stopped.set()
+            return { 'value': True }
+        if op != "call":
+            return { 'error': "Unknown op %s" % op, 'type': "ValueError" }
+
+        method = request.get("method", "")
+        if not method or method.startswith("_"):
+            return { 'error': "Bad method '%s'" % method, 'type': "ValueError" }
+
+        try:
+            git, lock = self.git(request["repo"])
+            with lock:
+                value = getattr(git, method)(*request.get("args", []), **request.get("kwargs", {}))
+            return { 'value': value }
+        except Exception, e:
+            code = getattr(e, 'errno', None)
+            return { 'error': str(e), 'errno': code if isinstance(code, int) else None,
+                     'cmd': getattr(e, 'cmd', None), 'type': type(e).__name__ }
+
+    def serve_connection(self, connection):
+
+        reader = connection.makefile("rb")
+        try:
+            for line in reader:
+                with self.lock:
+                    self.in_flight += 1
+                    self.requests += 1
+                try:
+                    try:
+                        response = self.handle(decode_value(json.loads(line)))
+                    except ValueError, e:
+                        response = { 'error': "Bad request: %s" % e, 'type': "ValueError" }
+                    connection.sendall(json.dumps(response, default = encode_value) + "\n")
+                finally:
+                    with self.lock:
+                        self.in_flight -= 1
+                        self.last_request = time.time()
+                if self.stopped.is_set():
+                    break
+        except socket.error:
+            pass
+        finally:
+            reader.close()
+            connection.close()
+
+    def bind(self):
+
+        listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            listener.bind(self.socket_path)
+        except socket.error, e:
+            if e.errno != errno.EADDRINUSE:
+                raise
+            # Somebody is there, or a daemon died and left its socket behind
+            probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                probe.connect(self.socket_path)
+                raise GitdError("A daemon is already serving %s" % self.socket_path, errno = errno.EADDRINUSE)
+            except socket.error:
+                os.unlink(self.socket_path)
+                listener.bind(self.socket_path)
+            finally:
+                probe.close()
+
+        os.chmod(self.socket_path, 0600)
+        listener.listen(64)
+        # Wake up now and then to see if we've been idle long enough
+        listener.settimeout(1)
+        return listener
+
+    def idle(self):
+
+        with self.lock:
+            return not self.in_flight and time.time() - self.last_request > self.idle_timeout
+
+    def serve(self):
+
+        listener = self.bind()
+        try:
+            while not self.stopped.is_set() and not self.idle():
+                try:
+                    connection, _address = listener.accept()
+                except socket.timeout:
+                    continue
+                uid = peer_uid(connection)
+                if uid is not None and uid != os.getuid():
+                    # Only the user the daemon runs as gets to use it
+                    connection.close()
+                    continue
+                connection.settimeout(None)
+                thread = threading.Thread(target = self.serve_connection, args = (connection,))
+                thread.daemon = True
+                thread.start()
+        finally:
+            listener.close()
+            try:
+                os.unlink(self.socket_path)
+            except OSError:
+                pass
+            self.invalidate()
+
+# ==================================================================================
+# Client
+
+class GitClient:
+
+    def __init__(self, repo = '.', socket_path = None, start = True, idle_timeout = DEFAULT_IDLE_TIMEOUT):
+
+        self.repo = os.path.abspath(repo)
+        self.socket_path = socket_path or default_socket_path()
+        self.start = start
+        self.idle_timeout = idle_timeout
+        self.connection = None
+        self.reader = None
+
+    # Every Git method appears here too
+    def __getattr__(self, name):
+
+        if name.startswith("_"):
+            raise AttributeError(name)
+
+        return lambda *args, **kwargs: self.call(name, *args, **kwargs)
+
+    # A connection to a daemon of ours, socket.error if nobody is there
+    def open_connection(self):
+
+        connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            connection.connect(self.socket_path)
+            check_daemon(connection, self.socket_path)
+            return connection
+        except:
+            connection.close()
+            raise
+
+    def connect(self):
+
+        try:
+            return self.open_connection()
+        except socket.error:
+            if not self.start:
+                raise
+
+        # Nobody there, start the daemon and wait for it
+        with open(os.devnull, "r+") as devnull:
+            subprocess.Popen([ sys.executable, os.path.abspath(__file__.replace(".pyc", ".py")), "serve",
+                               "--socket", self.socket_path, "--idle-timeout", str(self.idle_timeout) ],
+                             stdin = devnull, stdout = devnull, stderr = devnull, close_fds = True,
+                             preexec_fn = os.setsid)
+
+        deadline = time.time() + 10
+        while True:
+            try:
+                return self.open_connection()
+            except socket.error:
+                if time.time() > deadline:
+                    raise GitdError("Can't connect to %s" % self.socket_path, errno = errno.ECONNREFUSED)
+                time.sleep(0.02)
+
+    def request(self, request):
+
+        for attempt in (1, 2):
+            if not self.connection:
+                self.connection = self.connect()
+                self.reader = self.connection.makefile("rb")
+            try:
+                self.connection.sendall(json.dumps(request) + "\n")
+                line = self.reader.readline()
+                if line:
+                    break
+            except socket.error:
+                pass
+            # The daemon went away (e.g. idle), try once more with a new one
+            self.close()
+        else:
+            raise GitdError("No response from %s" % self.socket_path, errno = errno.ECONNRESET)
+
+        response = json.loads(line)
+        if 'error' in response:
+            raise GitdError(response['error'], errno = response.get('errno'), cmd = response.get('cmd'),
+                            error_type = response.get('type'))
+        return response['value']
+
+    def call(self, method, *args, **kwargs):
+
+        return self.request({ 'repo': self.repo, 'method': method, 'args': args, 'kwargs': kwargs })
+
+    def invalidate(self, all_repos = False):
+
+        return self.request({ 'op': "invalidate", 'repo': None if all_repos else self.repo })
+
+    def close(self):
+
+        if self.reader:
+            self.reader.close()
+        if self.connection:
+            self.connection.close()
+        self.connection = self.reader = None
+
+# ==================================================================================
+
+def print_value(value):
+
+    if value is None:
+        return
+    if isinstance(value, basestring):
+        print value
+    elif isinstance(value, list) and all(isinstance(each, basestring) for each in value):
+        print "\n".join(value)
+    else:
+        print json.dumps(value, indent = 2, sort_keys = True)
+
+def main():
+
+    parser = argparse.ArgumentParser(description = "Serve Git queries from a long-lived daemon")
+    parser.add_argument("--socket", help = "Unix socket path (default: $GITD_SOCKET, "
+                                           "or gitd.sock in $XDG_RUNTIME_DIR or /tmp/gitd-<uid>/)")
+    commands = parser.add_subparsers(dest = "command")
+
+    serve = commands.add_parser("serve", help = "Run the daemon")
+    serve.add_argument("--idle-timeout", type = float, default = DEFAULT_IDLE_TIMEOUT,
+                       help = "Exit after this many seconds without requests")
+    serve.add_argument("--fetch-freshness", type = float, default = 0)
+    serve.add_argument("--ls-remote-ttl", type = float, default = 0)
+    serve.add_argument("--socket", dest = "serve_socket")
+
+    call = commands.add_parser("call", help = "Call a Git method, e.g. call . current_revision")
+    call.add_argument("repo")
+    call.add_argument("method")
+    call.add_argument("args", nargs = "*")
+    call.add_argument("--kwargs", default = "{}", help = "Keyword arguments as a JSON object")
+
+    invalidate = commands.add_parser("invalidate", help = "Drop the cached state of a repo (of all repos by default)")
+    invalidate.add_argument("repo", nargs = "?")
+
+    commands.add_parser("ping", help = "Show the daemon's pid and repos")
+    commands.add_parser("stop", help = "Stop the daemon")
+
+    args = parser.parse_args()
+    socket_path = getattr(args, "serve_socket", None) or args.socket
+
+    if args.command == "serve":
+        import logging
+        try:
+            GitDaemon(socket_path, args.idle_timeout, args.fetch_freshness, args.ls_remote_ttl).serve()
+        except GitdError, e:
+            logging.error("%s", e)
+            return 1
+        return 0
+
+    client = GitClient(getattr(args, "repo", None) or ".", socket_path, start = args.command == "call")
+    try:
+        if args.command == "call":
+            print_value(client.call(args.method, *args.args, **json.loads(args.kwargs)))
+        elif args.command == "invalidate":
+            print_value(client.request({ 'op': "invalidate",
+                                         'repo': os.path.abspath(args.repo) if args.repo else None }))
+        else:
+            print_value(client.request({ 'op': args.command }))
+    except GitdError, e:
+        sys.stderr.write("%s\n" % e)
+        return e.errno if isinstance(e.errno, int) and e.errno else 1
+    except socket.error, e:
+        sys.stderr.write("No daemon at %s: %s\n" % (client.socket_path, e))
+        return 1
+    finally:
+        client.close()
+
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,222 @@
+# ==================================================================================
+# Per-file records of "git diff" output, read from the pipe as it comes.
+# A DiffEntry has what the file's header says (status, paths, modes, binary or not),
+# its hunks are read only when asked for - and only until the next entry is taken
+# from the stream, after which whatever wasn't read is skipped.
+# Examples:
+#  for entry in git.walk_diff("HEAD"):
+#      print entry.status, entry.path     ->  M junos/lib/foo.c
+#      if entry.path.endswith(".c"):
+#          print entry.body()             ->  '@@ -1,3 +1,3 @@\n-old\n+new\n...'
+
+# Lines starting a file's block in the output
+BLOCK_STARTS = ("diff --git ", "diff --cc ", "diff --combined ", "* Unmerged path ")
+
+C_ESCAPES = { 'a': "\a", 'b': "\b", 't': "\t", 'n': "\n", 'v': "\v", 'f': "\f", 'r': "\r" }
+
+def is_block_start(line):
+
+    return line.startswith(BLOCK_STARTS)
+
+# git quotes paths with unusual characters C-style: "dir/\303\244 \"x\"".
+# Returns (path, what follows it)
+def split_quoted(text):
+
+    if not text.startswith('"'):
+        return text, ""
+
+    chars = []
+    index = 1
+    while index < len(text) and text[index] != '"':
+        char = text[index]
+        if char == "\\" and index + 1 < len(text):
+            escaped = text[index + 1]
+            if escaped in "01234567":
+                chars.append(chr(int(text[index + 1:index + 4], 8)))
+                index += 4
+                continue
+            chars.append(C_ESCAPES.get(escaped, escaped))
+            index += 2
+            continue
+        chars.append(char)
+        index += 1
+
+    return "".join(chars), text[index + 1:].lstrip(" ")
+
+# Path from a "--- a/path" or "+++ b/path" line, None for /dev/null
+def header_path(name):
+
+    # git puts a tab after names with spaces
+    if name.endswith("\t"):
+        name = name[:-1]
+    name = split_quoted(name)[0]
+    if name == "/dev/null":
+        return None
+    return name[2:]
+
+# Paths from "diff --git a/old b/new"
+def git_line_paths(rest):
+
+    if rest.startswith('"'):
+        old, rest = split_quoted(rest)
+        new = split_quoted(rest)[0]
+        return old[2:], new[2:]
+
+    if rest.endswith('"'):
+        old, new = rest.split(' "', 1)
+        return old[2:], split_quoted('"' + new)[0][2:]
+
+    # Unquoted, with the same path on both sides (unless renamed, and then
+    # the rename lines tell): "a/<path> b/<path>"
+    half = (len(rest) - 1) // 2
+    if rest[half] == " " and rest[2:half] == rest[half + 3:]:
+        return rest[2:half], rest[half + 3:]
+
+    old, new = rest.split(" b/", 1)
+    return old[2:], new
+
+class DiffEntry:
+
+    def __init__(self, header, reader):
+
+        self.header = header
+        self.reader = reader
+        self.done = False
+
+        self.status = "M"
+        self.path = None
+        self.old_path = None
+        self.old_mode = None
+        self.new_mode = None
+        self.binary = False
+        self.parse_header()
+
+    def parse_header(self):
+
+        first = self.header[0].rstrip("\n")
+        if first.startswith("* Unmerged path "):
+            self.status = "U"
+            self.path = self.old_path = first[len("* Unmerged path "):]
+            return
+
+        for line in self.header[1:]:
+            line = line.rstrip("\n")
+            if line.startswith("new file mode "):
+                self.status = "A"
+                self.new_mode = line[len("new file mode "):]
+            elif line.startswith("deleted file mode "):
+                self.status = "D"
+                self.old_mode = line[len("deleted file mode "):]
+            elif line.startswith("old mode "):
+                self.old_mode = line[len("old mode "):]
+            elif line.startswith("new mode "):
+                self.new_mode = line[len("new mode "):]
+            elif line.startswith("rename from ") or line.startswith("copy from "):
+                self.status = "R" if line.startswith("rename") else "C"
+                self.old_path = split_quoted(line.split(" from ", 1)[1])[0]
+            elif line.startswith("rename to ") or line.startswith("copy to "):
+                self.path = split_quoted(line.split(" to ", 1)[1])[0]
+            elif line.startswith("index "):
+                # index 1c2b6e0..3ab5a2b 100644 (the mode is there if it didn't change)
+                fields = line.split(" ")
+                if len(fields) == 3:
+                    self.old_mode = self.old_mode or fields[2]
+                    self.new_mode = self.new_mode or fields[2]
+            elif line.startswith("--- "):
+                path = header_path(line[len("--- "):])
+                if path is not None and self.old_path is None:
+                    self.old_path = path
+            elif line.startswith("+++ "):
+                path = header_path(line[len("+++ "):])
+                if path is not None and self.path is None:
+                    self.path = path
+            elif line.startswith("Binary files "):
+                self.binary = True
+
+        if self.path is None or self.old_path is None:
+            old, new = git_line_paths(first.split(" ", 2)[2])
+            if self.old_path is None:
+                self.old_path = old
+            if self.path is None:
+                self.path = new
+
+        if self.status == "A":
+            self.old_path = None
+        elif self.status == "D":
+            self.path = self.old_path
+
+    # Lines of the hunks, as they come from the pipe
+    def lines(self):
+
+        if self.done:
+            raise ValueError("The diff of %s was read or skipped already" % self.path)
+
+        while True:
+            line = self.reader.next()
+            if line is None or is_block_start(line):
+                self.reader.push(line)
+                break
+            yield line
+
+        self.done = True
+
+    def body(self):
+
+        return "".join(self.lines())
+
+    # Header and hunks, all of it
+    def text(self):
+
+        return "".join(self.header) + self.body()
+
+    def skip(self):
+
+        if not self.done:
+            for _line in self.lines():
+                pass
+
+    def __repr__(self):
+
+        return "DiffEntry(%s %s)" % (self.status, self.path)
+
+# Line iterator we can push one line back into
+class LineReader:
+
+    def __init__(self, lines):
+
+        self.lines = iter(lines)
+        self.pending = None
+
+    def next(self):
+
+        if self.pending is not None:
+            line, self.pending = self.pending, None
+            return line
+        return next(self.lines, None)
+
+    def push(self, line):
+
+        self.pending = line
+
+# Yields a DiffEntry per file of "git diff" output lines
+def iter_diff(lines):
+
+    reader = LineReader(lines)
+    line = reader.next()
+    while line is not None:
+        if not is_block_start(line):
+            line = reader.next()
+            continue
+
+        header = [ line ]
+        line = reader.next()
+        while line is not None and not line.startswith("@@") and not is_block_start(line):
+            header.append(line)
+            line = reader.next()
+        reader.push(line)
+
+        entry = DiffEntry(header, reader)
+        yield entry
+        entry.skip()
+
+        line = reader.next()
@@ -0,0 +1,303 @@
+import os
+import re
+
+# ==================================================================================
+# Reads the state git keeps in files - HEAD, loose and packed refs, MERGE_HEAD,
+# rebase-merge/head-name and the repo's config - without running git.
+# Handles plain checkouts, ".git" files (submodules, worktrees) and bare repos
+# opened at their top directory. Whenever something looks unusual (GIT_DIR in the
+# environment, reftable refs, config includes, a ref we can't find...) the answer
+# is None, and the caller should ask git itself.
+# Examples:
+#  files = GitFiles("/path/to/repo")
+#  files.git_dir                            ->  '/path/to/repo/.git'
+#  files.abbrev_head()                      ->  'master' (or 'HEAD' when detached)
+#  files.resolve("HEAD")                    ->  '46dba5752ea0308cc204c3ddbf0cb04b3fe6f809'
+#  files.config_values("branch", "master", "merge")  ->  ['refs/heads/master']
+
+SHA_RE = re.compile(r"^[0-9a-f]{40}([0-9a-f]{24})?$")
+
+# Refs that belong to a worktree, everything else lives in the common dir
+WORKTREE_REF_RE = re.compile(r"^[A-Z_]*HEAD$|^refs/(bisect|worktree|rewritten)/")
+
+SECTION_RE = re.compile(r'^\[\s*([A-Za-z0-9.-]+)(?:\s+"((?:[^"\\]|\\.)*)")?\s*\]\s*(?:[#;].*)?$')
+KEY_RE = re.compile(r'^([A-Za-z][A-Za-z0-9-]*)\s*(?:=\s*(.*))?$')
+
+# Returns (section, subsection, key) -> [values] for the given config text,
+# or None if it uses anything we don't want to deal with here
+def parse_config(text):
+
+    values = {}
+    section = subsection = None
+
+    for line in text.splitlines():
+        line = line.strip()
+        if not line or line[0] in "#;":
+            continue
+
+        if line.startswith("["):
+            match = SECTION_RE.match(line)
+            if not match:
+                return None
+            section, subsection = match.group(1).lower(), match.group(2)
+            if subsection is not None:
+                subsection = re.sub(r'\\(.)', r'\1', subsection)
+            elif "." in section:
+                # Deprecated [section.subsection] syntax
+                section, subsection = section.split(".", 1)
+            if section in ("include", "includeif"):
+                return None
+            continue
+
+        match = KEY_RE.match(line)
+        if not match or section is None:
+            return None
+        if match.group(2) is None:
+            # "key" with no "=", a boolean we keep as None
+            value = None
+        else:
+            value = parse_config_value(match.group(2))
+            if value is None:
+                return None
+        values.setdefault((section, subsection, match.group(1).lower()), []).append(value)
+
+    return values
+
+def parse_config_value(raw):
+
+    value = []
+    keep = 0
+    quoted = False
+    chars = iter(raw)
+    for char in chars:
+        if char == '"':
+            quoted = not quoted
+            keep = len(value)
+        elif char == "\\":
+            escaped = next(chars, None)
+            if escaped is None:
+                # A line continuation
+                return None
+            value.append({ 'n': "\n", 't': "\t", 'b': "\b", '"': '"', '\\': "\\" }.get(escaped, None))
+            if value[-1] is None:
+                return None
+            keep = len(value)
+        elif char in "#;" and not quoted:
+            break
+        else:
+            value.append(char)
+            if quoted or not char.isspace():
+                keep = len(value)
+
+    if quoted:
+        return None
+
+    return "".join(value[:keep])
+
+def is_git_dir(path):
+
+    return os.path.isfile(os.path.join(path, "HEAD")) and \
+           (os.path.isdir(os.path.join(path, "objects")) or os.path.isfile(os.path.join(path, "commondir")))
+
+class GitFiles:
+
+    def __init__(self, path = '.'):
+
+        self.path = path
+        self.git_dir = None
+        self.common_dir = None
+        self.bare = False
+        # (stamp, parsed contents)
+        self.packed_refs_cache = (None, None)
+        self.config_cache = (None, None)
+
+        self.discover()
+
+    def discover(self):
+
+        if os.environ.get("GIT_DIR") or os.environ.get("GIT_COMMON_DIR") or os.environ.get("GIT_WORK_TREE"):
+            return
+
+        dot_git = os.path.join(self.path, ".git")
+        bare = False
+        try:
+            if os.path.isdir(dot_git):
+                git_dir = dot_git
+            elif os.path.isfile(dot_git):
+                # Submodules and worktrees have a "gitdir: <path>" file instead
+                with open(dot_git) as fdesc:
+                    line = fdesc.read().strip()
+                if not line.startswith("gitdir: "):
+                    return
+                git_dir = os.path.join(self.path, line[len("gitdir: "):])
+            elif is_git_dir(self.path):
+                git_dir = self.path
+                bare = True
+            else:
+                return
+
+            if not is_git_dir(git_dir):
+                return
+
+            common_dir = git_dir
+            commondir_file = os.path.join(git_dir, "commondir")
+            if os.path.isfile(commondir_file):
+                with open(commondir_file) as fdesc:
+                    common_dir = os.path.join(git_dir, fdesc.read().strip())
+
+        except (IOError, OSError):
+            return
+
+        # Refs in a reftable are git's business
+        if os.path.isdir(os.path.join(common_dir, "reftable")):
+            return
+
+        self.git_dir = os.path.normpath(git_dir)
+        self.common_dir = os.path.normpath(common_dir)
+
+        if bare:
+            # A bare repo, or the .git directory of a checkout?
+            values = self.config_values("core", None, "bare")
+            if not values or values[-1].lower() not in ("true", "yes", "on", "1"):
+                self.git_dir = self.common_dir = None
+                return
+            self.bare = True
+
+    def read(self, *path):
+
+        with open(os.path.join(*path)) as fdesc:
+            return fdesc.read()
+
+    def stamp(self, fname):
+
+        try:
+            stat = os.stat(fname)
+            return (stat.st_mtime, stat.st_size)
+        except OSError:
+            return (None, None)
+
+    def packed_refs(self):
+
+        fname = os.path.join(self.common_dir, "packed-refs")
+        stamp = self.stamp(fname)
+        if self.packed_refs_cache[0] == stamp:
+            return self.packed_refs_cache[1]
+
+        refs = {}
+        try:
+            # Lines look like this (the ^ line is the peeled tag):
+            # # pack-refs with: peeled fully-peeled sorted
+            # 46dba5752ea0308cc204c3ddbf0cb04b3fe6f809 refs/tags/master/pub-20141207.2
+            # ^21415606422f14de340c9978f56a8cf18ffd356e
+            for line in self.read(fname).splitlines():
+                if not line or line[0] in "#^":
+                    continue
+                sha, name = line.split(" ", 1)
+                refs[name] = sha
+        except IOError:
+            pass
+
+        self.packed_refs_cache = (stamp, refs)
+        return refs
+
+    # Full sha the given full ref name ("HEAD", "refs/heads/master") points at,
+    # or None if we can't tell
+    def resolve(self, ref, depth = 0):
+
+        if not self.git_dir or depth > 5:
+            return None
+
+        per_worktree = WORKTREE_REF_RE.match(ref)
+        try:
+            data = self.read(self.git_dir if per_worktree else self.common_dir, ref).strip()
+        except IOError:
+            if per_worktree:
+                return None
+            return self.packed_refs().get(ref)
+
+        if data.startswith("ref: "):
+            return self.resolve(data[len("ref: "):].strip(), depth + 1)
+        if SHA_RE.match(data):
+            return data
+
+    # Returns (refname, sha) of HEAD, refname is None for a detached HEAD
+    def head(self):
+
+        try:
+            data = self.read(self.git_dir, "HEAD").strip()
+        except IOError:
+            return None, None
+
+        if data.startswith("ref: "):
+            refname = data[len("ref: "):].strip()
+            return refname, self.resolve(refname)
+        if SHA_RE.match(data):
+            return None, data
+
+        return None, None
+
+    # What "git rev-parse --abbrev-ref HEAD" says, or None if we can't tell
+    def abbrev_head(self):
+
+        if not self.git_dir:
+            return None
+
+        refname, sha = self.head()
+        if not sha:
+            return None
+        if not refname:
+            return "HEAD"
+        if not refname.startswith("refs/heads/"):
+            return None
+
+        # git would add "heads/" if the short name is ambiguous
+        branch = refname[len("refs/heads/"):]
+        for other in ("refs/%s", "refs/tags/%s", "refs/remotes/%s", "refs/remotes/%s/HEAD"):
+            if self.resolve(other % branch):
+                return None
+
+        return branch
+
+    def merge_head(self):
+
+        try:
+            return self.read(self.git_dir, "MERGE_HEAD")
+        except IOError:
+            return None
+
+    # Branch being rebased by "git rebase -i/-m", None if there is no such rebase
+    def rebase_head_name(self):
+
+        try:
+            return self.read(self.git_dir, "rebase-merge", "head-name").rstrip("\n")
+        except IOError:
+            return None
+
+    def config(self):
+
+        fname = os.path.join(self.common_dir, "config")
+        stamp = self.stamp(fname)
+        if self.config_cache[0] != stamp:
+            try:
+                values = parse_config(self.read(fname))
+            except IOError:
+                values = None
+            # Per-worktree config is beyond us
+            worktree_config = (values or {}).get(("extensions", None, "worktreeconfig"))
+            if worktree_config and (worktree_config[-1] or "").lower() == "true":
+                values = None
+            self.config_cache = (stamp, values)
+
+        return self.config_cache[1]
+
+    # All the values of the given key in the repo's own config,
+    # None if there are none, or if we can't read the config
+    def config_values(self, section, subsection, key):
+
+        values = self.config()
+        if values is None:
+            return None
+
+        values = values.get((section.lower(), subsection, key.lower()))
+        if values and None not in values:
+            return values
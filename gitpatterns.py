@@ -0,0 +1,231 @@
+import os
+import tempfile
+import logging
+
+import gitdiff
+
+# ==================================================================================
+# .gitattributes and .gitignore files, read once into lines in order and an index of
+# their rules. Any number of rules can then be added or removed in memory - adding one
+# that is there already does nothing - and the file is written back once, by renaming
+# a new file over it. Comments, blank lines and the order of what stays are kept.
+# Examples:
+#  with AttributesFile("repo/.gitattributes") as attributes:
+#      attributes.add("*.bin", "-text -diff")      ->  True
+#      attributes.add("*.bin", "-text  -diff")     ->  False (there already)
+#      attributes.remove("*.o")                    ->  1 (lines removed)
+#  attributes.attributes("*.bin")                  ->  ['-text -diff']
+#
+#  ignore = IgnoreFile("repo/.gitignore")
+#  ignore.add("build/")
+#  ignore.save()
+
+# What's common to both files. The file kinds (AttributesFile, IgnoreFile) give it:
+#  key(line)  ->  what the line is a rule for, None for comments and blank lines
+#  line(key)  ->  the line (without its line end) for a rule
+class PatternFile:
+
+    def __init__(self, fname):
+
+        self.fname = fname
+        # Lines as they were read (with their line end), None once removed
+        self.lines = []
+        # Rule key -> positions in self.lines
+        self.index = {}
+        self.changed = False
+        self.load()
+
+    def __enter__(self):
+
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+
+        if exc_type is None:
+            self.save()
+
+    def __len__(self):
+
+        return len(self.index)
+
+    def __contains__(self, key):
+
+        return key in self.index
+
+    def load(self):
+
+        try:
+            with open(self.fname) as fdesc:
+                for line in fdesc:
+                    self.append(line)
+        except IOError:
+            # No such file yet, save() will create it
+            pass
+
+    def append(self, line):
+
+        key = self.key(line)
+        if key is not None:
+            self.index.setdefault(key, []).append(len(self.lines))
+        self.lines.append(line)
+
+    def add_key(self, key):
+
+        if key in self.index:
+            return False
+
+        # The last line may have no line end
+        for position in xrange(len(self.lines) - 1, -1, -1):
+            last = self.lines[position]
+            if last is not None:
+                if not last.endswith("\n"):
+                    self.lines[position] = last + "\n"
+                break
+
+        self.append(self.line(key) + "\n")
+        self.changed = True
+        return True
+
+    def remove_keys(self, keys):
+
+        removed = 0
+        for key in keys:
+            for position in self.index.pop(key, []):
+                self.lines[position] = None
+                removed += 1
+
+        if removed:
+            self.changed = True
+        return removed
+
+    def rules(self):
+
+        return sorted(self.index, key = lambda key: self.index[key][0])
+
+    def text(self):
+
+        return "".join(line for line in self.lines if line is not None)
+
+    # Writes the file back if anything changed, returns True if it did
+    def save(self):
+
+        if not self.changed:
+            return False
+
+        directory = os.path.dirname(os.path.abspath(self.fname))
+        try:
+            mode = os.stat(self.fname).st_mode & 0777
+        except OSError:
+            umask = os.umask(0)
+            os.umask(umask)
+            mode = 0666 & ~umask
+
+        fdesc, tmp_name = tempfile.mkstemp(dir = directory, prefix = ".%s-" % os.path.basename(self.fname))
+        try:
+            with os.fdopen(fdesc, "w") as tmp_file:
+                tmp_file.write(self.text())
+            # mkstemp() makes it private, it's a checked in file
+            os.chmod(tmp_name, mode)
+            os.rename(tmp_name, self.fname)
+        except (IOError, OSError):
+            try:
+                os.unlink(tmp_name)
+            except OSError:
+                pass
+            raise
+
+        logging.debug("Updated %s", self.fname)
+
+        # Positions start over with what was written
+        lines = [ line for line in self.lines if line is not None ]
+        self.lines = []
+        self.index = {}
+        for line in lines:
+            self.append(line)
+        self.changed = False
+        return True
+
+# Rules are (pattern, attributes), with the attributes as one string:
+# ("*.bin", "-text -diff")
+class AttributesFile(PatternFile):
+
+    def key(self, line):
+
+        line = line.strip()
+        if not line or line.startswith("#"):
+            return None
+
+        if line.startswith('"'):
+            pattern, rest = gitdiff.split_quoted(line)
+        else:
+            pattern, _sep, rest = line.partition(" ")
+            if "\t" in pattern:
+                pattern, _sep, more = pattern.partition("\t")
+                rest = more + " " + rest
+        return (pattern, " ".join(rest.split()))
+
+    def line(self, key):
+
+        pattern, attributes = key
+        if attributes:
+            return "%s %s" % key
+        return pattern
+
+    def add(self, pattern, attributes = ""):
+
+        return self.add_key((pattern, " ".join(attributes.split())))
+
+    # Removes the lines giving the pattern these attributes (any attributes if None),
+    # returns how many lines went
+    def remove(self, pattern, attributes = None):
+
+        if attributes is not None:
+            return self.remove_keys([ (pattern, " ".join(attributes.split())) ])
+        return self.remove_keys([ key for key in self.index if key[0] == pattern ])
+
+    def has(self, pattern, attributes):
+
+        return (pattern, " ".join(attributes.split())) in self.index
+
+    # Attributes given to the pattern, in file order
+    def attributes(self, pattern):
+
+        return [ key[1] for key in self.rules() if key[0] == pattern ]
+
+    def patterns(self):
+
+        patterns = []
+        for pattern, _attributes in self.rules():
+            if pattern not in patterns:
+                patterns.append(pattern)
+        return patterns
+
+# Rules are the patterns themselves: "build/", "!keep.o", "*.pyc"
+class IgnoreFile(PatternFile):
+
+    def key(self, line):
+
+        line = line.rstrip("\r\n")
+        # Trailing spaces don't count, unless escaped
+        stripped = line.rstrip(" ")
+        if stripped.endswith("\\") and stripped != line:
+            stripped += " "
+        if not stripped or stripped.startswith("#"):
+            return None
+        return stripped
+
+    def line(self, key):
+
+        return key
+
+    def add(self, pattern):
+
+        return self.add_key(pattern)
+
+    def remove(self, pattern):
+
+        return self.remove_keys([ pattern ])
+
+    def patterns(self):
+
+        return self.rules()
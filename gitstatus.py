@@ -0,0 +1,135 @@
+from collections import namedtuple
+
+# ==================================================================================
+# The state of the index and the work tree from one
+#  git status --porcelain=v2 -z
+# indexed by path (and by original path, for renames and copies).
+# Every entry has two states: 'index' is the index against HEAD, 'worktree' the work
+# tree against the index, each one of "." (unchanged), M, T, A, D, R, C or U.
+# Examples:
+#  snapshot = StatusSnapshot(output)
+#  "lib/foo.c" in snapshot          ->  True
+#  snapshot.get("lib/foo.c")        ->  StatusEntry(kind='1', index='M', worktree='.', path='lib/foo.c', orig_path=None)
+#  snapshot.is_dirty("lib/foo.c")   ->  True
+#  snapshot.renamed_to("lib/old.c") ->  'lib/new.c'
+
+# kind is "1" (changed), "2" (renamed or copied), "u" (unmerged), "?" (untracked) or "!" (ignored)
+StatusEntry = namedtuple("StatusEntry", "kind index worktree path orig_path")
+
+# What file_is_dirty() always took for dirty: added, copied, modified or renamed,
+# in the index or in the work tree, and unmerged whatever the states
+DIRTY_STATES = "ACMR"
+
+class StatusSnapshot:
+
+    def __init__(self, output):
+
+        self.entries = {}
+        # Original path -> entry, for renames and copies
+        self.origins = {}
+        # "# branch.oid 46dba57...", "# branch.head master"... when asked for
+        self.headers = {}
+
+        # Records look like this, the path (and the original path) are NUL-terminated:
+        # 1 .M N... 100644 100644 100644 3ab5a2b... 3ab5a2b... lib/foo.c
+        # 2 R. N... 100644 100644 100644 1c2b6e0... 1c2b6e0... R100 lib/new.c<NUL>lib/old.c
+        # u UU N... 100644 100644 100644 100644 9190de7... 2141560... 46dba57... lib/bar.c
+        # ? build/out.o
+        fields = output.split("\0")
+        index = 0
+        while index < len(fields):
+            record = fields[index]
+            index += 1
+            if not record:
+                continue
+
+            kind = record[0]
+            orig_path = None
+            if kind == "1":
+                parts = record.split(" ", 8)
+            elif kind == "2":
+                parts = record.split(" ", 9)
+                orig_path = fields[index]
+                index += 1
+            elif kind == "u":
+                parts = record.split(" ", 10)
+            elif kind in "?!":
+                parts = [ kind, kind * 2, record[2:] ]
+            elif kind == "#":
+                name, _sep, value = record[2:].partition(" ")
+                self.headers[name] = value
+                continue
+            else:
+                continue
+
+            entry = StatusEntry(kind, parts[1][0], parts[1][1], parts[-1], orig_path)
+            self.entries[entry.path] = entry
+            if orig_path is not None:
+                self.origins[orig_path] = entry
+
+    def __len__(self):
+
+        return len(self.entries)
+
+    def __contains__(self, path):
+
+        return path in self.entries
+
+    def __iter__(self):
+
+        return iter(sorted(self.entries))
+
+    def get(self, path):
+
+        return self.entries.get(path)
+
+    # State of the path in the index (against HEAD), "." if it's unchanged
+    def index_state(self, path):
+
+        entry = self.entries.get(path)
+        return entry.index if entry else "."
+
+    # State of the path in the work tree (against the index), "." if it's unchanged
+    def worktree_state(self, path):
+
+        entry = self.entries.get(path)
+        return entry.worktree if entry else "."
+
+    def is_dirty(self, path):
+
+        entry = self.entries.get(path)
+        if entry and entry.kind == "u":
+            return True
+        return bool(entry and entry.kind in "12" and
+                    (entry.index in DIRTY_STATES or entry.worktree in DIRTY_STATES))
+
+    def is_unmerged(self, path):
+
+        entry = self.entries.get(path)
+        return bool(entry and entry.kind == "u")
+
+    def is_untracked(self, path):
+
+        entry = self.entries.get(path)
+        return bool(entry and entry.kind == "?")
+
+    # Where a renamed (or copied) path came from, None if it wasn't renamed
+    def renamed_from(self, path):
+
+        entry = self.entries.get(path)
+        if entry:
+            return entry.orig_path
+
+    # Where a path was renamed (or copied) to, None if it wasn't
+    def renamed_to(self, orig_path):
+
+        entry = self.origins.get(orig_path)
+        if entry:
+            return entry.path
+
+    # The given paths (all paths if None) that are dirty, in order
+    def dirty(self, paths = None):
+
+        if paths is None:
+            paths = sorted(self.entries)
+        return [ path for path in paths if self.is_dirty(path) ]
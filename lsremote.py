@@ -0,0 +1,158 @@
+import os
+import time
+import errno
+import hashlib
+import tempfile
+import threading
+
+import refs
+
+# ==================================================================================
+# An on-disk cache of "git ls-remote" advertisements, keyed by remote URL.
+# One full advertisement is stored per remote, in the same format a RefSnapshot is
+# built from, so tags and heads of a remote come out of one ls-remote, and other
+# processes asking within 'ttl' seconds read the file instead of asking the remote.
+# Files are written next to their final name and renamed into place, so a reader
+# never sees half a file.
+# Examples:
+#  cache = LsRemoteCache(ttl = 300)
+#  snapshot = cache.get("ssh://git/repo", lambda: git.ls_remote("ssh://git/repo", verbose = False))
+#  snapshot.names("refs/tags/")   ->  ['refs/tags/master/pub-20141207.2', ...]
+#  cache.invalidate("ssh://git/repo")
+
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "git-ls-remote")
+
+# Converts ls-remote output to what RefSnapshot wants. The output looks like this
+# (the ^{} line is what the annotated tag before it points at):
+# 46dba5752ea0308cc204c3ddbf0cb04b3fe6f809        refs/heads/master
+# 21415606422f14de340c9978f56a8cf18ffd356e        refs/tags/master/pub-20141207.2
+# 9190de7b1a167a002362b47700ea3760e1d4904b        refs/tags/master/pub-20141207.2^{}
+def ls_remote_to_refs(output):
+
+    shas = {}
+    peeled = {}
+    for line in output.splitlines():
+        if "\t" not in line:
+            continue
+        sha, name = line.split("\t", 1)
+        if name.endswith("^{}"):
+            peeled[name[:-3]] = sha
+        else:
+            shas[name] = sha
+
+    return "\n".join("%s %s %s" % (sha, peeled.get(name, ""), name) for name, sha in shas.iteritems())
+
+class LsRemoteCache:
+
+    def __init__(self, ttl = 300, cache_dir = None):
+
+        self.ttl = ttl
+        self.cache_dir = cache_dir or os.environ.get("GIT_LS_REMOTE_CACHE") or DEFAULT_CACHE_DIR
+        self.lock = threading.Lock()
+        # url -> RefSnapshot parsed from the file with the snapshot's stamp
+        self.snapshots = {}
+
+    def file_name(self, url):
+
+        return os.path.join(self.cache_dir, hashlib.sha1(url).hexdigest())
+
+    # Returns a RefSnapshot of the remote, from the cache if it is fresh enough,
+    # otherwise from build() (the output of a full "git ls-remote <url>")
+    def get(self, url, build):
+
+        fname = self.file_name(url)
+
+        with self.lock:
+            snapshot = self.read(url, fname)
+            if snapshot is not None:
+                return snapshot
+
+        # Don't hold the lock while talking to the remote
+        output = ls_remote_to_refs(build())
+
+        with self.lock:
+            stamp = self.write(url, fname, output)
+            snapshot = refs.RefSnapshot(output, stamp)
+            if stamp:
+                self.snapshots[url] = snapshot
+            return snapshot
+
+    def read(self, url, fname):
+
+        try:
+            stat = os.stat(fname)
+        except OSError:
+            return None
+
+        if time.time() - stat.st_mtime >= self.ttl:
+            return None
+
+        stamp = (stat.st_mtime, stat.st_size)
+        snapshot = self.snapshots.get(url)
+        if snapshot is not None and snapshot.stamp == stamp:
+            return snapshot
+
+        try:
+            with open(fname) as fdesc:
+                header = fdesc.readline()
+                # Guard against hash collisions and files written by somebody else
+                if header != "# %s\n" % url:
+                    return None
+                snapshot = refs.RefSnapshot(fdesc.read(), stamp)
+        except (IOError, ValueError):
+            return None
+
+        self.snapshots[url] = snapshot
+        return snapshot
+
+    # Returns the stamp of the new file, None if it couldn't be written
+    def write(self, url, fname, output):
+
+        try:
+            os.makedirs(self.cache_dir)
+        except OSError, e:
+            if e.errno != errno.EEXIST:
+                return None
+
+        try:
+            fdesc, tmp_name = tempfile.mkstemp(dir = self.cache_dir, prefix = ".tmp-")
+        except OSError:
+            return None
+
+        try:
+            with os.fdopen(fdesc, "w") as tmp_file:
+                tmp_file.write("# %s\n" % url)
+                tmp_file.write(output)
+            os.rename(tmp_name, fname)
+            stat = os.stat(fname)
+        except (IOError, OSError):
+            try:
+                os.unlink(tmp_name)
+            except OSError:
+                pass
+            return None
+
+        return (stat.st_mtime, stat.st_size)
+
+    # Drop what we know about the given remote (or all remotes), e.g. after pushing to it
+    def invalidate(self, url = None):
+
+        with self.lock:
+            urls = [ url ] if url else self.snapshots.keys()
+            for each in urls:
+                self.snapshots.pop(each, None)
+
+            if url:
+                fnames = [ self.file_name(url) ]
+            else:
+                try:
+                    fnames = [ os.path.join(self.cache_dir, name) for name in os.listdir(self.cache_dir)
+                               if not name.startswith(".") ]
+                except OSError:
+                    fnames = []
+
+            for fname in fnames:
+                try:
+                    os.unlink(fname)
+                except OSError:
+                    pass
@@ -0,0 +1,207 @@
+import os
+import fcntl
+import fnmatch
+import tempfile
+
+# ==================================================================================
+# Maps every commit to the first pub tag (in name order, the one "git tag -l --contains"
+# lists first) containing it, kept in a file so other processes don't walk the
+# history again.
+# Pub tags only come, so the map is extended rather than rebuilt: a new tag T only
+# changes commits that no already indexed tag sorting before T contains, and those
+# are exactly "git log T --not <indexed tags before T>". If an indexed tag moves or
+# goes away the map is built from scratch.
+# The file is only appended to, so a process reads and writes what is new to it;
+# it is only written anew when the map is built from scratch.
+# Examples:
+#  index = PubTagIndex("/path/to/repo/.git/pub-tags-index")
+#  index.update(git.ref_snapshot(), git.walk_commits)
+#  index.first_containing('46dba5752ea0...')  ->  'v/master/pub-20141207.2'
+
+PUB_TAG_PATTERN = "v/*/pub-*"
+
+class PubTagIndex:
+
+    def __init__(self, fname, pattern = PUB_TAG_PATTERN):
+
+        self.fname = fname
+        self.pattern = pattern
+        # The snapshot we're up to date with
+        self.snapshot = None
+        self.reset()
+        self.load()
+
+    def reset(self):
+
+        # Tag names, tag name -> (sha, peeled sha) of the tags indexed
+        self.names = []
+        self.tags = {}
+        # Commit sha -> index of its tag in self.names
+        self.containing = {}
+        # (inode, offset) of the file as far as it was read, None if it's to be written anew
+        self.read_up_to = None
+
+    # The file looks like this, tags and commits with the position of their tag in the
+    # order they were added, a later line for a commit taking over:
+    # tag 46dba5752ea0308cc204c3ddbf0cb04b3fe6f809 21415606422f14de340c9978f56a8cf18ffd356e v/master/pub-20141207.2
+    # 21415606422f14de340c9978f56a8cf18ffd356e 0
+    # Only what was appended since the last load() is read.
+    def load(self):
+
+        try:
+            fdesc = open(self.fname)
+        except IOError:
+            self.reset()
+            return
+
+        with fdesc:
+            stat = os.fstat(fdesc.fileno())
+            if self.read_up_to and self.read_up_to[0] == stat.st_ino and self.read_up_to[1] <= stat.st_size:
+                offset = self.read_up_to[1]
+                fdesc.seek(offset)
+            else:
+                # Written anew by someone else, or not read yet
+                self.reset()
+                offset = 0
+
+            try:
+                for line in fdesc:
+                    if not line.endswith("\n"):
+                        # Not all there (yet)
+                        break
+                    if line.startswith("tag "):
+                        _tag, sha, peeled, name = line.rstrip("\n").split(" ", 3)
+                        self.tags[name] = (sha, peeled)
+                        self.names.append(name)
+                    else:
+                        sha, position = line.split()
+                        self.containing[sha] = int(position)
+                    offset += len(line)
+            except ValueError:
+                self.reset()
+                return
+
+            self.read_up_to = (stat.st_ino, offset)
+
+    # Writes the given tag names and commit sha -> position after what's in the file,
+    # or the whole index into a new file if it can't simply be added to
+    def save(self, names, commits):
+
+        lines = [ "tag %s %s %s\n" % (self.tags[name] + (name,)) for name in names ]
+        lines.extend("%s %d\n" % item for item in commits.iteritems())
+
+        if self.read_up_to:
+            try:
+                with open(self.fname, "a") as fdesc:
+                    stat = os.fstat(fdesc.fileno())
+                    # A line cut short by a writer that died can't be written after
+                    if (stat.st_ino, stat.st_size) == self.read_up_to:
+                        fdesc.write("".join(lines))
+                        fdesc.flush()
+                        self.read_up_to = (stat.st_ino, fdesc.tell())
+                        return
+            except (IOError, OSError):
+                return
+
+        try:
+            fdesc, tmp_name = tempfile.mkstemp(dir = os.path.dirname(self.fname), prefix = ".pub-tags-")
+        except OSError:
+            return
+
+        try:
+            with os.fdopen(fdesc, "w") as tmp_file:
+                for name in self.names:
+                    tmp_file.write("tag %s %s %s\n" % (self.tags[name] + (name,)))
+                for sha, position in self.containing.iteritems():
+                    tmp_file.write("%s %d\n" % (sha, position))
+                tmp_file.flush()
+                stat = os.fstat(tmp_file.fileno())
+            os.rename(tmp_name, self.fname)
+            self.read_up_to = (stat.st_ino, stat.st_size)
+        except (IOError, OSError):
+            try:
+                os.unlink(tmp_name)
+            except OSError:
+                pass
+
+    # Processes updating the index take turns, each one starting from what the one
+    # before it wrote. Returns the lock file, None if there can't be one
+    def lock(self):
+
+        try:
+            fdesc = open(self.fname + ".lock", "a")
+        except IOError:
+            return None
+
+        try:
+            fcntl.flock(fdesc.fileno(), fcntl.LOCK_EX)
+        except IOError:
+            fdesc.close()
+            return None
+        return fdesc
+
+    # Brings the index up to date with the pub tags in the given refs.RefSnapshot,
+    # walk(args, revisions = ...) is Git.walk_commits. Returns True if anything changed.
+    def update(self, snapshot, walk):
+
+        if snapshot is self.snapshot:
+            return False
+
+        tags = {}
+        for refname, sha, peeled in snapshot.peeled_refs("refs/tags/"):
+            name = refname[len("refs/tags/"):]
+            if fnmatch.fnmatchcase(name, self.pattern):
+                tags[name] = (sha, peeled)
+
+        lock = self.lock()
+        try:
+            # What other processes added meanwhile
+            self.load()
+
+            if any(tags.get(name) != value for name, value in self.tags.iteritems()):
+                self.reset()
+
+            new = sorted(name for name in tags if name not in self.tags)
+            if new:
+                # Whatever the tags sorting before the new ones contain stays as it is.
+                # There may be any number of either, so they go through stdin
+                revisions = set(tags[name][0] for name in new)
+                revisions.update("^%s" % self.tags[name][0] for name in self.names if name < new[0])
+
+                # Commit sha -> the first new tag a commit walked so far has it as an ancestor
+                first = {}
+                for name in reversed(new):
+                    first[tags[name][1]] = name
+
+                positions = {}
+                for name in new:
+                    positions[name] = len(self.names)
+                    self.names.append(name)
+                    self.tags[name] = tags[name]
+
+                # Children come before parents, so a commit's first tag is known when we get to it
+                changed = {}
+                for entry in walk("--topo-order", revisions = sorted(revisions)):
+                    name = first.pop(entry.sha, None)
+                    if name is None:
+                        continue
+                    position = self.containing.get(entry.sha)
+                    if position is None or self.names[position] > name:
+                        self.containing[entry.sha] = changed[entry.sha] = positions[name]
+                    for parent in entry.parents:
+                        if parent not in first or first[parent] > name:
+                            first[parent] = name
+
+                self.save(new, changed)
+        finally:
+            if lock:
+                lock.close()
+
+        self.snapshot = snapshot
+        return bool(new)
+
+    def first_containing(self, sha):
+
+        position = self.containing.get(sha)
+        if position is not None:
+            return self.names[position]
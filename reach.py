@@ -0,0 +1,116 @@
+# ==================================================================================
+# Answers "which branches contain each of these commits" for many commits at once.
+# Built from topological walks (parents before children) of the commits the branches
+# reach. Each commit gets an integer id (its position in the walks) and a generation
+# number (1 for root commits, otherwise 1 + the highest generation of its parents).
+# A query then goes down from the newest commit once, passing a bitset of the
+# branches each commit is reachable from on to its parents. Commits with a lower
+# generation than every queried commit can't lead to any of them and are skipped,
+# and the walk stops as soon as the last queried commit is reached.
+# When branches move, only the commits new to the index are walked and appended:
+# their parents are in the index already, or come before them in the new walk.
+# Examples:
+#  index = ReachabilityIndex()
+#  index.extend(git.walk_commits("--topo-order --reverse --remotes"))
+#  index.set_tips(snapshot.refs("refs/remotes/"))
+#  index.containing(['46dba5752ea0...', '21415606422f...'])
+#    ->  {'46dba5752ea0...': ['refs/remotes/origin/master'], '21415606422f...': []}
+#  index.missing(new_tips)   ->  shas to walk ("<missing> --not <index.walked>") into the index
+# Only the current tips are excluded from the next walk: commits of branches that
+# went away may be walked again, and are skipped.
+
+class ReachabilityIndex:
+
+    def __init__(self):
+
+        # sha -> id, and by id: ids of the parents, generation
+        self.ids = {}
+        self.parents = []
+        self.generation = []
+        # Current tips, everything reachable from them is in the index
+        self.walked = set()
+        # (refname, sha) of the branches, as given to set_tips()
+        self.tips = ()
+        # One bit per branch, bit N is self.names[N]
+        self.names = []
+        self.tip_bits = {}
+
+    def __len__(self):
+
+        return len(self.parents)
+
+    # Adds 'commits', CommitEntry-like (sha, parents) with parents before children,
+    # those in the index already are skipped
+    def extend(self, commits):
+
+        ids = self.ids
+        parents = self.parents
+        generation = self.generation
+        for entry in commits:
+            if entry.sha in ids:
+                continue
+            # Parents outside the walk (shallow clones) are dropped
+            commit_parents = tuple(ids[sha] for sha in entry.parents if sha in ids)
+            ids[entry.sha] = len(parents)
+            parents.append(commit_parents)
+            generation.append(1 + max([ generation[parent] for parent in commit_parents ] or [ 0 ]))
+
+    # Tip shas the index knows nothing about yet
+    def missing(self, tips):
+
+        return sorted(set(sha for _name, sha in tips if sha not in self.ids))
+
+    def set_tips(self, tips):
+
+        self.tips = tuple(tips)
+        self.walked = set(sha for _name, sha in self.tips if sha in self.ids)
+        self.names = sorted(name for name, sha in self.tips if sha in self.ids)
+        shas = dict(self.tips)
+        self.tip_bits = {}
+        for bit, name in enumerate(self.names):
+            index = self.ids[shas[name]]
+            self.tip_bits[index] = self.tip_bits.get(index, 0) | (1 << bit)
+
+    def decode(self, mask):
+
+        names = []
+        while mask:
+            low = mask & -mask
+            names.append(self.names[low.bit_length() - 1])
+            mask ^= low
+
+        return names
+
+    # Returns full sha -> sorted names of the branches containing it,
+    # commits no branch reaches get []
+    def containing(self, shas):
+
+        result = dict((sha, []) for sha in shas)
+
+        targets = dict((self.ids[sha], sha) for sha in result if sha in self.ids)
+        if not targets:
+            return result
+
+        generation = self.generation
+        parents = self.parents
+        tip_bits = self.tip_bits
+        min_generation = min(generation[index] for index in targets)
+
+        # index -> branches seen so far, for commits not reached yet
+        bits = {}
+        for index in xrange(len(parents) - 1, min(targets) - 1, -1):
+            if generation[index] < min_generation:
+                continue
+
+            mask = bits.pop(index, 0) | tip_bits.get(index, 0)
+            if not mask:
+                continue
+
+            if index in targets:
+                result[targets[index]] = self.decode(mask)
+
+            for parent in parents[index]:
+                if generation[parent] >= min_generation:
+                    bits[parent] = bits.get(parent, 0) | mask
+
+        return result
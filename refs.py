@@ -0,0 +1,163 @@
+import os
+import bisect
+import threading
+
+# ==================================================================================
+# An in-memory snapshot of all refs in a repository, built from one
+#  git for-each-ref --format='%(objectname) %(*objectname) %(refname)'
+#
+# Ref names are kept sorted, so all refs under a prefix are one bisect away,
+# and every ref is indexed by the sha it points at (and, for annotated tags,
+# by the sha of the peeled object too).
+# Examples:
+#  snapshot = RefSnapshot(output)
+#  snapshot.get("refs/remotes/origin/master")        ->  '46dba5752ea0...'
+#  snapshot.names("refs/remotes/origin/v/master/")    ->  ['refs/remotes/origin/v/master/0.0.1', ...]
+#  snapshot.points_at('46dba5752ea0...', "refs/tags/")  ->  ['refs/tags/master/pub-20141207.2']
+
+FOR_EACH_REF_FORMAT = "%(objectname) %(*objectname) %(refname)"
+
+class RefSnapshot:
+
+    def __init__(self, output, stamp = None):
+
+        # Each line looks like this (the middle column is empty unless this is an annotated tag):
+        # 46dba5752ea0308cc204c3ddbf0cb04b3fe6f809  refs/remotes/origin/master
+        # 21415606422f14de340c9978f56a8cf18ffd356e 9190de7b1a167a002362b47700ea3760e1d4904b refs/tags/t1
+        entries = []
+        for line in output.splitlines():
+            sha, peeled, name = line.split(" ", 2)
+            entries.append((name, sha, peeled))
+        entries.sort()
+
+        self.stamp = stamp
+        self.refnames = [ name for name, _sha, _peeled in entries ]
+        self.shas = [ sha for _name, sha, _peeled in entries ]
+        # What annotated tags point at, the same as shas for everything else
+        self.peeled = [ peeled or sha for _name, sha, peeled in entries ]
+
+        # sha -> positions in refnames
+        self.by_sha = {}
+        for index, (_name, sha, peeled) in enumerate(entries):
+            self.by_sha.setdefault(sha, []).append(index)
+            if peeled and peeled != sha:
+                self.by_sha.setdefault(peeled, []).append(index)
+
+    def __len__(self):
+
+        return len(self.refnames)
+
+    def _range(self, prefix):
+
+        start = bisect.bisect_left(self.refnames, prefix)
+        if not prefix:
+            return start, len(self.refnames)
+
+        stop = start
+        if prefix[-1] != "\xff":
+            # The first name that sorts after every name starting with prefix
+            stop = bisect.bisect_left(self.refnames, prefix[:-1] + chr(ord(prefix[-1]) + 1), start)
+        else:
+            while stop < len(self.refnames) and self.refnames[stop].startswith(prefix):
+                stop += 1
+
+        return start, stop
+
+    def get(self, refname):
+
+        index = bisect.bisect_left(self.refnames, refname)
+        if index < len(self.refnames) and self.refnames[index] == refname:
+            return self.shas[index]
+
+    def names(self, prefix = ""):
+
+        start, stop = self._range(prefix)
+        return self.refnames[start:stop]
+
+    def refs(self, prefix = ""):
+
+        start, stop = self._range(prefix)
+        return zip(self.refnames[start:stop], self.shas[start:stop])
+
+    # (refname, sha, peeled sha) of refs starting with prefix
+    def peeled_refs(self, prefix = ""):
+
+        start, stop = self._range(prefix)
+        return zip(self.refnames[start:stop], self.shas[start:stop], self.peeled[start:stop])
+
+    # Names of refs (starting with prefix) pointing at the given full sha,
+    # directly or through an annotated tag
+    def points_at(self, sha, prefix = ""):
+
+        names = [ self.refnames[index] for index in self.by_sha.get(sha, []) ]
+        return sorted(name for name in names if name.startswith(prefix))
+
+# ==================================================================================
+# Holds the latest RefSnapshot of a repository. Git objects working on the same
+# repository (e.g. on its worktrees) may share one.
+# Examples:
+#  cache = RefCache()
+#  cache.get(git_dir, lambda: git.for_each_ref("--format='%s'" % FOR_EACH_REF_FORMAT))
+
+class RefCache:
+
+    def __init__(self):
+
+        self.lock = threading.Lock()
+        self.snapshot = None
+
+    # Returns the cached snapshot, or a new one built from build() if the refs
+    # in git_dir have changed since
+    def get(self, git_dir, build):
+
+        with self.lock:
+            if self.snapshot is None or not self.snapshot.stamp.is_fresh(git_dir):
+                # Stamped before reading the refs: whatever changes meanwhile shows next time
+                stamp = RefsStamp(git_dir)
+                self.snapshot = RefSnapshot(build(), stamp)
+            return self.snapshot
+
+# ==================================================================================
+# Anything that changes refs changes packed-refs or one of the directories under refs/
+# (loose refs are written to a lock file and renamed, new ones may need a new
+# directory), so the mtimes of those tell us when a snapshot is stale.
+# The tree is walked once, when stamping: checking the stamp stats packed-refs and
+# the directories and loose refs found then, and nothing else.
+
+class RefsStamp:
+
+    def __init__(self, git_dir):
+
+        self.git_dir = git_dir
+        self.packed_refs = os.path.join(git_dir, "packed-refs")
+        self.packed = file_stamp(self.packed_refs)
+        # path -> stamp of the directories and of the loose refs
+        self.dirs = {}
+        self.files = {}
+
+        for root, _dirs, files in os.walk(os.path.join(git_dir, "refs")):
+            self.dirs[root] = file_stamp(root)
+            for name in files:
+                path = os.path.join(root, name)
+                self.files[path] = file_stamp(path)
+
+    def is_fresh(self, git_dir):
+
+        if git_dir != self.git_dir or file_stamp(self.packed_refs) != self.packed:
+            return False
+
+        for stamps in (self.dirs, self.files):
+            for path, stamp in stamps.iteritems():
+                if file_stamp(path) != stamp:
+                    return False
+
+        return True
+
+# (mtime, size, inode), None if there is no such file
+def file_stamp(path):
+
+    try:
+        stat = os.stat(path)
+        return (stat.st_mtime, stat.st_size, stat.st_ino)
+    except OSError:
+        return None
@@ -1,3 +1,21 @@
+import sys
+import os
+import copy
+import json
+import time
+import bisect
+import inspect
+import shlex
+import logging
+import threading
+import multiprocessing
+import multiprocessing.queues
+import Queue
+import traceback
+import subprocess
+import collections
+import cPickle as pickle
+
 # ==================================================================================
 class RunError(Exception):
     def __init__(self, ex_info, errno = None, cmd = None, trace = None):
@@ -9,6 +27,286 @@ class RunError(Exception):
     def __str__(self):
         return self.ex_info
 
+# ==================================================================================
+# Output sinks for run(cmd, stdout = subprocess.PIPE, sinks = [...])
+# Every line of the command's output (with its '\n') goes to each sink as it arrives.
+# A sink is a callable taking the line, or anything with a write() method (e.g. an
+# open file). flush() and finish() are called, if the sink has them, after each
+# chunk of output and once the command is done.
+# Examples:
+#  tail = TailSink(20)
+#  run("git gc", stdout = subprocess.PIPE, sinks = [EchoSink(), tail, lambda line: log.append(line)])
+#  run("git repack -ad", stdout = subprocess.PIPE, sinks = [TeeSink("/tmp/repack.log")])
+
+READ_CHUNK_SIZE = 64 * 1024
+
+class EchoSink:
+
+    def __init__(self, fdesc = None):
+
+        self.fdesc = fdesc or sys.stdout
+
+    def write(self, line):
+
+        self.fdesc.write(line)
+
+    def flush(self):
+
+        self.fdesc.flush()
+
+# Keeps the last 'lines' lines, e.g. for error messages
+class TailSink:
+
+    def __init__(self, lines = 20):
+
+        self.lines = collections.deque(maxlen = lines)
+
+    def write(self, line):
+
+        self.lines.append(line)
+
+    def text(self):
+
+        return "".join(self.lines)
+
+# Keeps all the lines
+class CaptureSink:
+
+    def __init__(self):
+
+        self.lines = []
+
+    def write(self, line):
+
+        self.lines.append(line)
+
+    def text(self):
+
+        return "".join(self.lines)
+
+# Copies the output into a file, given by its name or as an open file
+class TeeSink:
+
+    def __init__(self, fname, mode = "w"):
+
+        if isinstance(fname, basestring):
+            self.fdesc = open(fname, mode)
+            self.owner = True
+        else:
+            self.fdesc = fname
+            self.owner = False
+
+    def write(self, line):
+
+        self.fdesc.write(line)
+
+    def flush(self):
+
+        self.fdesc.flush()
+
+    def finish(self):
+
+        if self.owner:
+            self.fdesc.close()
+        else:
+            self.fdesc.flush()
+
+# Reads the given file descriptor in big chunks and yields it line by line,
+# "\r\n" and "\r" line breaks become "\n" (like universal_newlines does)
+def iter_lines(fd, chunk_size = READ_CHUNK_SIZE):
+
+    pending = ""
+    while True:
+        chunk = os.read(fd, chunk_size)
+        if not chunk:
+            break
+
+        data = pending + chunk
+        # A '\r' at the end of the chunk may be followed by a '\n' in the next one
+        carry = ""
+        if data.endswith("\r"):
+            data, carry = data[:-1], "\r"
+
+        lines = data.replace("\r\n", "\n").replace("\r", "\n").split("\n")
+        pending = lines.pop() + carry
+        for line in lines:
+            yield line + "\n"
+
+    if pending:
+        yield pending.replace("\r", "\n")
+
+def feed_sinks(fd, sinks):
+
+    writers = [ sink if callable(sink) else sink.write for sink in sinks ]
+    flushers = [ sink.flush for sink in sinks if hasattr(sink, 'flush') ]
+
+    lines = 0
+    for line in iter_lines(fd):
+        for writer in writers:
+            writer(line)
+        lines += 1
+        # Flush once in a while, not after every line
+        if not lines % 256:
+            for flusher in flushers:
+                flusher()
+
+    for flusher in flushers:
+        flusher()
+    for sink in sinks:
+        if hasattr(sink, 'finish'):
+            sink.finish()
+
+# ==================================================================================
+# Instrumentation: hooks called around every command run() runs
+#  pre hooks:   hook(argv, cwd)
+#  post hooks:  hook(RunRecord(argv, cwd, duration, errno, output_size, method))
+# Hooks are called in the thread running the command, so they have to be
+# thread safe. With no hooks installed run() only looks at an empty tuple.
+# 'method' is the Git method that ran the command when that is known before the
+# post hooks run (e.g. for output streamed to whoever iterates over it), else None.
+# Examples:
+#  add_run_hooks(post = lambda record: logging.info("%s took %.3fs", record.argv, record.duration))
+
+RunRecord = collections.namedtuple("RunRecord", "argv cwd duration errno output_size method")
+
+pre_run_hooks = ()
+post_run_hooks = ()
+run_hooks_lock = threading.Lock()
+
+def add_run_hooks(pre = None, post = None):
+
+    global pre_run_hooks, post_run_hooks
+
+    with run_hooks_lock:
+        if pre:
+            pre_run_hooks += (pre,)
+        if post:
+            post_run_hooks += (post,)
+
+def remove_run_hooks(pre = None, post = None):
+
+    global pre_run_hooks, post_run_hooks
+
+    with run_hooks_lock:
+        pre_run_hooks = tuple(hook for hook in pre_run_hooks if hook is not pre)
+        post_run_hooks = tuple(hook for hook in post_run_hooks if hook is not post)
+
+# For commands run outside of run(), e.g. long-lived pipes
+def notify_pre_run(argv, cwd):
+
+    for hook in pre_run_hooks:
+        hook(argv, cwd)
+
+def notify_post_run(argv, cwd, start, errno, output_size, method = None):
+
+    if post_run_hooks:
+        record = RunRecord(argv, cwd, time.time() - start, errno, output_size, method)
+        for hook in post_run_hooks:
+            hook(record)
+
+# "git -C path -c x=y log --oneline" -> "log"
+def git_subcommand(argv):
+
+    if not argv or os.path.basename(argv[0]) != "git":
+        return os.path.basename(argv[0]) if argv else None
+
+    args = iter(argv[1:])
+    for arg in args:
+        if arg in ("-C", "-c", "--git-dir", "--work-tree", "--namespace"):
+            next(args, None)
+        elif not arg.startswith("-"):
+            return arg
+
+# Frames between a Git method and the command it runs
+PLUMBING_FRAMES = ("run", "<lambda>", "__getattr__", "stream_lines")
+# Git generators: the Git method iterating over them is the one running the command
+GENERATOR_FRAMES = ("walk_commits", "walk_diff")
+
+# The name of the Git method (if any) up the stack from the caller
+def calling_git_method():
+
+    generator = None
+    frame = sys._getframe(1)
+    while frame:
+        obj = frame.f_locals.get('self')
+        name = frame.f_code.co_name
+        if obj is not None and name not in PLUMBING_FRAMES and \
+           any(cls.__name__ == "Git" for cls in inspect.getmro(obj.__class__)):
+            if name not in GENERATOR_FRAMES:
+                return name
+            # Unless it's iterated over from outside of Git
+            generator = name
+        frame = frame.f_back
+
+    return generator
+
+# ==================================================================================
+# Collects count, errors, output size and a latency histogram of the commands
+# run() runs, per git subcommand and per calling Git method.
+# Examples:
+#  stats = RunStats().install()
+#  ... run the pipeline ...
+#  stats.uninstall()
+#  stats.dump_json("/tmp/git-stats.json")
+
+# Upper bounds (in ms) of the histogram buckets, the last bucket is everything slower
+HISTOGRAM_BOUNDS_MS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000, 30000, 60000)
+
+class RunStats:
+
+    def __init__(self):
+
+        self.lock = threading.Lock()
+        self.subcommands = {}
+        self.methods = {}
+
+    def install(self):
+
+        add_run_hooks(post = self.record)
+        return self
+
+    def uninstall(self):
+
+        remove_run_hooks(post = self.record)
+        return self
+
+    def add(self, table, key, record):
+
+        stats = table.get(key)
+        if not stats:
+            stats = table[key] = { 'count': 0, 'errors': 0, 'seconds': 0.0, 'min': None, 'max': 0.0,
+                                   'output_bytes': 0, 'histogram': [ 0 ] * (len(HISTOGRAM_BOUNDS_MS) + 1) }
+
+        stats['count'] += 1
+        if record.errno:
+            stats['errors'] += 1
+        stats['seconds'] += record.duration
+        stats['min'] = record.duration if stats['min'] is None else min(stats['min'], record.duration)
+        stats['max'] = max(stats['max'], record.duration)
+        stats['output_bytes'] += record.output_size
+        stats['histogram'][bisect.bisect_left(HISTOGRAM_BOUNDS_MS, record.duration * 1000)] += 1
+
+    def record(self, record):
+
+        subcommand = git_subcommand(record.argv) or "?"
+        method = record.method or calling_git_method() or "?"
+
+        with self.lock:
+            self.add(self.subcommands, subcommand, record)
+            self.add(self.methods, method, record)
+
+    def as_dict(self):
+
+        with self.lock:
+            return { 'histogram_bounds_ms': list(HISTOGRAM_BOUNDS_MS),
+                     'subcommands': copy.deepcopy(self.subcommands),
+                     'methods': copy.deepcopy(self.methods) }
+
+    def dump_json(self, fname):
+
+        with open(fname, "w") as fdesc:
+            json.dump(self.as_dict(), fdesc, indent = 2, sort_keys = True)
+
 # ==================================================================================
 def run(cmd, **kwargs):
 
@@ -16,6 +314,9 @@ def run(cmd, **kwargs):
     verbose = kwargs.pop('verbose', False)
     raise_exception = kwargs.pop('raise_exception', True)
     exit_on_error = kwargs.pop('exit_on_error', False)
+    # Where the output goes when stdout is subprocess.PIPE,
+    # by default it is printed and returned
+    sinks = kwargs.pop('sinks', None)
 
     # If stderr is not there, redirect it to stdout
     if kwargs.get('stderr', None) == None:
@@ -30,19 +331,33 @@ def run(cmd, **kwargs):
     if verbose:
         logging.info("Running command '%s', cwd '%s'", " ".join(cmd), kwargs.get('cwd', None))
 
+    if pre_run_hooks:
+        notify_pre_run(cmd, kwargs.get('cwd', None))
+    start = time.time()
+
     try:
         # Run the command
         stdout = kwargs.get('stdout', None)
-        if stdout:
+        if stdout == subprocess.PIPE:
+            output = ""
+            if sinks is None:
+                sinks = [ EchoSink(), CaptureSink() ]
+            # Feed the stdout to the sinks as it arrives
+            p = subprocess.Popen(cmd, **kwargs)
+            try:
+                feed_sinks(p.stdout.fileno(), sinks)
+            finally:
+                p.stdout.close()
+                # Wait until the command is done
+                errno = p.wait()
+            # Return what the sinks kept, if any of them did
+            for sink in sinks:
+                if hasattr(sink, 'text'):
+                    output = sink.text()
+                    break
+        elif stdout:
             output = ""
-            # Print the stdout as it arrives
             p = subprocess.Popen(cmd, bufsize = 1, universal_newlines = True, **kwargs)
-            if stdout == subprocess.PIPE:
-                for line in iter(p.stdout.readline, ''):
-                    line = line.replace('\r', '').replace('\n', '')
-                    output += line
-                    print line
-                    sys.stdout.flush()
             # Wait until the command is done
             errno = p.wait()
         else:
@@ -72,6 +387,9 @@ def run(cmd, **kwargs):
         # We never need the trailing '\n', so get rid of it here
         output = output.rstrip()
 
+        if post_run_hooks:
+            notify_post_run(cmd, kwargs.get('cwd', None), start, errno, len(output))
+
         if errno:
             if exit_on_error:
                 if stdout == subprocess.PIPE:
@@ -143,103 +461,274 @@ class Runner():
         return run(cmd, cwd=self.cwd, **pass_kwargs)
 
 # ==================================================================================
-# Go over the given entries and spawn the given function in parallel threads
-def forall(jobs, entries, func, *args, **kwargs):
+# Go over the given entries and run the given function on each of them,
+# yielding a ForallResult for each entry as it completes (ordered = False)
+# or in the order of the entries (ordered = True).
+# The executor decides where func runs:
+#  "threads"    'jobs' threads (the default), fine for functions waiting on git
+#  "processes"  a pool of 'jobs' processes, for CPU bound python functions;
+#               func, its arguments, entries and results must be picklable
+#  "inline"     one by one in the calling thread (the default when jobs is 0)
+# Workers take the next entry as soon as they are free, and entries are read
+# lazily: only 'window' entries (by default four per job) may be running or done
+# but not yet collected. What func returns is passed on untouched (in 'result').
+# If it raises, its exception type (in 'error') and traceback text (in 'trace') are
+# reported instead, and no new entries are started - the ones already running are
+# still reported. With errno_results = True, func returns an errno, and a non-zero
+# one is a failure too (that's how forall() has it).
+# Examples:
+#  for result in forall_iter(8, repos, update_repo, progress_bar_name = "Update"):
+#      if result.error:
+#          logging.error("%s failed: %s", result.entry, result.trace)
+#  forall_iter(8, diffs, convert_diff, executor = "processes", ordered = False)
+
+ForallResult = collections.namedtuple("ForallResult", "index entry result error trace")
+
+FORALL_EXECUTORS = ("threads", "processes", "inline")
+
+# Returns (what func returned, exception type, traceback text)
+def run_func(func, entry, *args, **kwargs):
+
+    try:
+        return func(entry, *args, **kwargs), None, None
+    except:
+        exc_type, exc_value, exc_traceback = sys.exc_info()
+        traceback.print_exception(exc_type, exc_value, exc_traceback)
+        return None, exc_type, "".join(traceback.format_exception(exc_type, exc_value, exc_traceback))
+
+# Set in pool processes: where they say which entry they start on, and who they are.
+# If a worker dies (killed, crashed...) the pool never gives its entry back
+worker_starts = None
+
+def init_forall_worker(starts):
 
-    def run_func(func, entry, *args, **kwargs):
-        try:
-            errno = func(entry, *args, **kwargs)
-        except:
-            exc_type, exc_value, exc_traceback = sys.exc_info()
-            traceback.print_exception(exc_type, exc_value, exc_traceback)
-            errno = sys.exc_info()[0]
-        finally:
-            return errno
-
-    class Worker(threading.Thread):
-
-        def __init__(self, event, entries, func, *args, **kwargs):
-
-            threading.Thread.__init__(self)
-            self.event = event
-            self.entries = entries
-            self.func = func
-            self.args = args
-            self.kwargs = kwargs
-            self.errno = 0
-            self.progress_bar = self.kwargs.pop('progress_bar', None)
-
-        def run(self):
-
-            for entry in self.entries:
-                if self.event.is_set():
+    global worker_starts
+    worker_starts = starts
+
+# Runs in a pool process, whatever happens the result must make it back to us
+def run_func_in_process(func, index, entry, args, kwargs):
+
+    if worker_starts is not None:
+        worker_starts.put((index, os.getpid()))
+
+    result = ForallResult(index, entry, *run_func(func, entry, *args, **kwargs))
+    try:
+        pickle.dumps(result, pickle.HIGHEST_PROTOCOL)
+    except Exception, e:
+        result = ForallResult(index, entry, None, result.error or type(e),
+                              result.trace or "Can not send the result back: %s" % e)
+    return result
+
+def forall_inline(entries, func, args, kwargs, event):
+
+    for index, entry in enumerate(entries):
+        if event.is_set():
+            return
+        yield ForallResult(index, entry, *run_func(func, entry, *args, **kwargs))
+
+# The executors take one of the 'slots' for every entry they start,
+# forall_iter() gives it back once the entry's result is yielded
+
+def forall_threads(jobs, entries, func, args, kwargs, slots, event):
+
+    lock = threading.Lock()
+    iterator = enumerate(entries)
+    results = Queue.Queue()
+    done = object()
+    failures = []
+
+    def worker():
+        while not event.is_set():
+            slots.acquire()
+            if event.is_set():
+                # Pass the slot on to the next worker waiting for one, it's done too
+                slots.release()
+                break
+            with lock:
+                try:
+                    index, entry = next(iterator)
+                except StopIteration:
+                    slots.release()
                     break
-                self.errno = run_func(func, entry, *args, **self.kwargs)
-                if self.errno:
-                    self.event.set()
-                    if self.progress_bar:
-                        self.progress_bar.stop(status = "Error")
-                    return self.errno
-                if self.progress_bar:
-                    self.progress_bar.add()
-
-        def join(self, timeout = None):
-            threading.Thread.join(self, timeout = timeout)
-            return self.errno
+                except Exception, e:
+                    # The entries themselves failed
+                    failures.append(e)
+                    event.set()
+                    slots.release()
+                    break
+            results.put(ForallResult(index, entry, *run_func(func, entry, *args, **kwargs)))
+        results.put(done)
 
-    jobs = int(jobs)
+    threads = []
+    for _thread_id in range(jobs):
+        thread = threading.Thread(target = worker)
+        thread.daemon = True
+        threads.append(thread)
+        thread.start()
+
+    running = len(threads)
+    try:
+        while running:
+            result = results.get()
+            if result is done:
+                running -= 1
+                continue
+            yield result
+
+    finally:
+        # Wake up the threads waiting for a slot, so they can see we are done
+        event.set()
+        for _thread in threads:
+            slots.release()
+
+    if failures:
+        raise failures[0]
+
+def forall_processes(jobs, entries, func, args, kwargs, slots, event):
+
+    try:
+        pickle.dumps((func, args, kwargs), pickle.HIGHEST_PROTOCOL)
+    except Exception, e:
+        raise RunError("Can not run %s in worker processes: %s" % (getattr(func, '__name__', func), e))
+
+    # A SimpleQueue writes right away, the message is there even if the worker dies next
+    starts = multiprocessing.queues.SimpleQueue()
+    pool = multiprocessing.Pool(jobs or None, init_forall_worker, (starts,))
+    results = Queue.Queue()
+    iterator = enumerate(entries)
+    # index -> entry, until its result is yielded
+    submitted = {}
+    # index -> pid of the worker running it
+    running = {}
+
+    def submit():
+        for index, entry in iterator:
+            submitted[index] = entry
+            try:
+                pickle.dumps(entry, pickle.HIGHEST_PROTOCOL)
+            except Exception, e:
+                # The pool would never call us back for this one
+                results.put(ForallResult(index, entry, None, type(e), "Can not send %r to a worker: %s" % (entry, e)))
+            else:
+                pool.apply_async(run_func_in_process, (func, index, entry, args, kwargs), callback = results.put)
+            return True
+        return False
+
+    # Entries whose worker died, as failed results
+    def lost_results():
+        while not starts.empty():
+            index, pid = starts.get()
+            if index in submitted:
+                running[index] = pid
+        # The pool has no public way of telling, its workers are in _pool
+        alive = set(process.pid for process in pool._pool if process.exitcode is None)
+        return [ ForallResult(index, submitted[index], None, RunError,
+                              "Worker process %d died running %r" % (pid, submitted[index]))
+                 for index, pid in running.items() if pid not in alive ]
 
-    num_entries = len(entries)
-    if not num_entries:
-        return 0
+    try:
+        outstanding = 0
+        exhausted = False
+        while True:
+            # As many new entries as there are free slots
+            while not exhausted and not event.is_set() and slots.acquire(False):
+                if submit():
+                    outstanding += 1
+                else:
+                    slots.release()
+                    exhausted = True
+
+            if not outstanding:
+                break
+
+            try:
+                result = results.get(timeout = 1)
+            except Queue.Empty:
+                for result in lost_results():
+                    results.put(result)
+                continue
+
+            if result.index not in submitted:
+                # Reported lost already
+                continue
+            del submitted[result.index]
+            running.pop(result.index, None)
+            outstanding -= 1
+            yield result
+
+    finally:
+        pool.terminate()
+        pool.join()
+
+def forall_iter(jobs, entries, func, *args, **kwargs):
+
+    jobs = int(jobs)
+    ordered = kwargs.pop('ordered', True)
+    window = kwargs.pop('window', None) or max(jobs, 1) * 4
+    executor = kwargs.pop('executor', None) or ("threads" if jobs else "inline")
+    errno_results = kwargs.pop('errno_results', False)
 
     progress_bar_name = kwargs.pop('progress_bar_name', None)
     if progress_bar_name:
+        num_entries = len(entries) if hasattr(entries, '__len__') else None
         progress_bar = ProgressBar(name = progress_bar_name, items = num_entries)
-        kwargs['progress_bar'] = progress_bar
     else:
         progress_bar = None
 
-    # We may run just as a simple loop, if no jobs are given
-    if jobs == 0:
-        for entry in entries:
-            errno = run_func(func, entry, *args, **kwargs)
-            if errno:
-                if progress_bar:
-                    progress_bar.stop(status = "Error")
-                return errno
+    event = threading.Event()
+    # Entries running, or done but not yielded yet (in ordered mode, maybe waiting for
+    # an earlier entry): taken when an entry starts, given back when it's yielded
+    slots = threading.Semaphore(window)
+    if executor == "inline":
+        results = forall_inline(entries, func, args, kwargs, event)
+    elif executor == "threads":
+        results = forall_threads(jobs, entries, func, args, kwargs, slots, event)
+    elif executor == "processes":
+        results = forall_processes(jobs, entries, func, args, kwargs, slots, event)
+    else:
+        raise RunError("Unknown forall executor '%s', use one of: %s" % (executor, ", ".join(FORALL_EXECUTORS)))
+
+    # Results that completed ahead of an earlier entry wait here in ordered mode
+    pending = {}
+    next_index = 0
+    try:
+        for result in results:
+            failed = result.error is not None or (errno_results and result.result)
+            if failed:
+                # Stop starting new entries
+                event.set()
+
             if progress_bar:
-                progress_bar.add()
-        return 0
+                if failed:
+                    progress_bar.stop(status = "Error")
+                else:
+                    progress_bar.add()
 
-    event = threading.Event()
+            if not ordered:
+                yield result
+                slots.release()
+                continue
 
-    chunk_size = (num_entries/jobs)
-    if num_entries < jobs:
-        chunk_size = 1
+            pending[result.index] = result
+            while next_index in pending:
+                yield pending.pop(next_index)
+                next_index += 1
+                slots.release()
 
-    threads = []
-    for thread_id in range(0, jobs):
-        # Divide our entries list into chunks
-        start = thread_id * chunk_size
-        # Make sure the last chunk is big enough to cover the rest of the entries
-        if thread_id == jobs -1:
-            stop = None
-        else:
-            stop = (thread_id + 1) * chunk_size
-        chunk = list(entries)[start:stop]
-        if not chunk:
-            # we are done
-            break
-        # Create and start a new thread
-        thread = Worker(event, chunk, func, *args, **kwargs)
-        threads.append(thread)
-        thread.start()
+    finally:
+        results.close()
+
+# Go over the given entries and run the given function in parallel threads (or processes).
+# Returns the number of failed entries (run inline: the errno of the first failure)
+def forall(jobs, entries, func, *args, **kwargs):
+
+    inline = (kwargs.get('executor') or ("threads" if int(jobs) else "inline")) == "inline"
 
-    # Wait for all threads to complete and see if there were any errors
     errors = 0
-    for thread in threads:
-        if thread.join():
+    for result in forall_iter(jobs, entries, func, *args, ordered = False, errno_results = True, **kwargs):
+        if result.error is not None or result.result:
+            if inline:
+                return result.error or result.result
             errors += 1
 
     return errors
@@ -1,6 +1,22 @@
-def svn_diff_to_git(svn_branch, svn_root, svn_map_path, svn_diff):
+import os
+import re
+import time
+import logging
+import itertools
+import collections
+import multiprocessing
+
+# ==================================================================================
+# Converts an SVN diff into a git diff, line by line, so that huge diffs
+# never have to be in memory at once. 'svn_diff' is anything yielding lines
+# (a list, a file object, a pipe), converted lines are yielded as they are ready.
+# Examples:
+#  with open("big.diff") as src, open("big.git.diff", "w") as dst:
+#      dst.writelines(iter_svn_diff_to_git("trunk", svn_root, "junos/include", src))
 
-    git_diff = "Index: %s\n" % svn_map_path
+def iter_svn_diff_to_git(svn_branch, svn_root, svn_map_path, svn_diff):
+
+    yield "Index: %s\n" % svn_map_path
 
     if svn_branch == "trunk":
         branch_pattern = "(trunk\/)"
@@ -8,16 +24,29 @@ def svn_diff_to_git(svn_branch, svn_root, svn_map_path, svn_diff):
         branch_pattern = "(branches\/%s\/)" % svn_branch
     path_pattern = branch_pattern + "([^\s^@]*)"
 
-    for line in svn_diff.splitlines(True):
+    # Compile once per conversion, not once per line
+    diff_git_re = re.compile(r"^(diff --git )(a\/)%s(\s)(b\/)%s$" % (path_pattern, path_pattern))
+    file_re = re.compile(r"^(--- |\+\+\+ )(((a\/|b\/)%s)|/dev/null)(.*)$" % path_pattern)
+    deleted_re = re.compile(r"^deleted file mode(.*)$")
+    copy_re = re.compile(r"^(copy from |copy to )(%s)(@\d+)?" % path_pattern)
+
+    relpath = os.path.relpath
+
+    for line in svn_diff:
+        # Most lines are diff contents, don't bother matching those
+        if not line.startswith(("diff --git ", "--- ", "+++ ", "deleted file mode", "copy ")):
+            yield line
+            continue
+
         # We are looking for this line:
         # diff --git a/branches/DEV_COMMON_BRANCH/junos/include/jnx/appid_api.h b/branches/DEV_COMMON_BRANCH/junos/include/jnx/appid_api.h.new
-        match = re.match(r"^(diff --git )(a\/)%s(\s)(b\/)%s$" % (path_pattern, path_pattern), line)
+        match = diff_git_re.match(line)
         if match:
             # match.groups() is:
             # ('diff --git ', 'a/', 'branches/DEV_COMMON_BRANCH/', 'junos/include/jnx/appid_api.h',
             #   ' ', 'b/', 'branches/DEV_COMMON_BRANCH/', 'junos/include/jnx/appid_api.h.new')
-            git_diff += match.group(1) + match.group(2) + os.path.relpath(match.group(4), svn_map_root) + \
-                        match.group(5) + match.group(6) + os.path.relpath(match.group(8), svn_map_root) + '\n'
+            yield match.group(1) + match.group(2) + relpath(match.group(4), svn_map_path) + \
+                  match.group(5) + match.group(6) + relpath(match.group(8), svn_map_path) + '\n'
             # The end result is:
             # diff --git a/jnx/appid_api.h b/jnx/appid_api.h.new
             continue
@@ -25,25 +54,25 @@ def svn_diff_to_git(svn_branch, svn_root, svn_map_path, svn_diff):
         # We are lookning for something like:
         # --- a/branches/DEV_COMMON_BRANCH/junos/include/jnx/appid_api.h.new  (revision 918415)
         # +++ /dev/null   (working copy)
-        match = re.match(r"^(--- |\+\+\+ )(((a\/|b\/)%s)|/dev/null)(.*)$" % path_pattern, line)
+        match = file_re.match(line)
         if match:
             if match.group(4):
                 # match.groups() is:
                 # ('--- ', 'a/branches/DEV_COMMON_BRANCH/junos/include/jnx/appid_api.h.new',
                 #  'a/branches/DEV_COMMON_BRANCH/junos/include/jnx/appid_api.h.new',
                 #  'a/', 'branches/DEV_COMMON_BRANCH/', 'junos/include/jnx/appid_api.h.new', '  (revision 918415)')
-                fname = match.group(4) + os.path.relpath(match.group(6), svn_map_root)
+                fname = match.group(4) + relpath(match.group(6), svn_map_path)
             else:
                 # match.groups() is:
                 # ('+++ ', '/dev/null', None, None, None, None, '   (working copy)')
                 fname = match.group(2)
-            git_diff += match.group(1) + fname + '\n'
+            yield match.group(1) + fname + '\n'
             continue
 
         # We are looking for something like:
         # deleted file mode 10644
         # new file mode 10644
-        match = re.match(r"^deleted file mode(.*)$", line)
+        match = deleted_re.match(line)
         if match:
             # The modes may be incompatible, let's skip this for now
             continue
@@ -51,14 +80,97 @@ def svn_diff_to_git(svn_branch, svn_root, svn_map_path, svn_diff):
         # We are looking for something like:
         # copy from branches/DEV_COMMON_BRANCH/junos/include/jnx/appid_api.h@918415
         # copy to branches/DEV_COMMON_BRANCH/junos/include/jnx/appid_api.h.new
-        match = re.match(r"^(copy from |copy to )(%s)(@\d+)?" % path_pattern, line)
+        match = copy_re.match(line)
         if match:
             # match.groups is:
             # ('copy from ', 'branches/DEV_COMMON_BRANCH/junos/include/jnx/appid_api.h',
             #  'branches/DEV_COMMON_BRANCH/', 'junos/include/jnx/appid_api.h', '@918415')
-            git_diff += match.group(1) + os.path.relpath(match.group(4), svn_map_root) + '\n'
+            yield match.group(1) + relpath(match.group(4), svn_map_path) + '\n'
             continue
 
-        git_diff += line
+        yield line
+
+def svn_diff_to_git(svn_branch, svn_root, svn_map_path, svn_diff):
+
+    return "".join(iter_svn_diff_to_git(svn_branch, svn_root, svn_map_path, svn_diff.splitlines(True)))
+
+# ==================================================================================
+# Every line converts on its own, so a huge diff can be cut into shards and the
+# shards converted in parallel processes. Shards are cut only where a new file
+# section starts ("Index: " or "diff --git " lines) and put back together in
+# their original order, so the result is byte-identical to the serial conversion.
+# Only a few shards per process are read ahead, the diff is still streamed.
+# Examples:
+#  timings = []
+#  with open("big.diff") as src, open("big.git.diff", "w") as dst:
+#      dst.writelines(parallel_svn_diff_to_git("trunk", svn_root, "junos/include", src,
+#                                              jobs = 8, timings = timings))
+#  timings  ->  [{'shard': 0, 'lines': 91234, 'bytes': 4194410, 'seconds': 0.41}, ...]
+
+SHARD_SIZE = 4 * 1024 * 1024
+
+def iter_svn_diff_shards(svn_diff, shard_size = SHARD_SIZE):
+
+    shard = []
+    size = 0
+    for line in svn_diff:
+        if size >= shard_size and line.startswith(("Index: ", "diff --git ")):
+            yield shard
+            shard = []
+            size = 0
+        shard.append(line)
+        size += len(line)
+
+    if shard:
+        yield shard
+
+# Like pool.imap(), but reads no more than 'window' tasks ahead of the result
+# being yielded: imap() takes all the tasks in at once, and with them the whole diff
+def bounded_imap(pool, func, tasks, window):
+
+    pending = collections.deque()
+    for task in tasks:
+        pending.append(pool.apply_async(func, (task,)))
+        if len(pending) >= window:
+            yield pending.popleft().get()
+
+    while pending:
+        yield pending.popleft().get()
+
+# Runs in a pool process: converts one shard (without the leading "Index:" line)
+def convert_svn_diff_shard(args):
+
+    svn_branch, svn_root, svn_map_path, shard = args
+
+    start = time.time()
+    output = "".join(itertools.islice(iter_svn_diff_to_git(svn_branch, svn_root, svn_map_path, shard), 1, None))
+
+    return output, len(shard), time.time() - start
+
+def parallel_svn_diff_to_git(svn_branch, svn_root, svn_map_path, svn_diff,
+                             jobs = None, shard_size = SHARD_SIZE, timings = None):
+
+    yield "Index: %s\n" % svn_map_path
+
+    tasks = ((svn_branch, svn_root, svn_map_path, shard) for shard in iter_svn_diff_shards(svn_diff, shard_size))
+
+    # jobs = 0 converts the shards right here, one by one
+    if jobs == 0:
+        pool = None
+        results = itertools.imap(convert_svn_diff_shard, tasks)
+    else:
+        pool = multiprocessing.Pool(jobs)
+        # Two shards per process in flight keeps them all busy
+        results = bounded_imap(pool, convert_svn_diff_shard, tasks, 2 * (jobs or multiprocessing.cpu_count()))
+
+    try:
+        for index, (output, lines, seconds) in enumerate(results):
+            logging.debug("svn diff shard %d: %d lines, %d bytes in %.3fs", index, lines, len(output), seconds)
+            if timings is not None:
+                timings.append({'shard': index, 'lines': lines, 'bytes': len(output), 'seconds': seconds})
+            yield output
 
-    return git_diff
+    finally:
+        if pool:
+            pool.terminate()
+            pool.join()
@@ -0,0 +1,67 @@
+import os
+import shutil
+import tempfile
+import unittest
+import subprocess
+
+from git import Git
+
+# ==================================================================================
+# What the status snapshot takes for dirty is what the two "git diff --diff-filter=ACMR"
+# calls found before, unmerged paths included.
+
+class DirtyFilesTest(unittest.TestCase):
+
+    def setUp(self):
+
+        self.path = tempfile.mkdtemp(prefix = "test-gitstatus-")
+        self.git("init", "-q")
+        self.git("config", "user.email", "test@example.com")
+        self.git("config", "user.name", "Test")
+        for fname in ("conflict.txt", "clean.txt", "changed.txt"):
+            self.write(fname, "one\n")
+        self.git("add", ".")
+        self.git("commit", "-q", "-m", "one")
+
+        self.git("checkout", "-q", "-b", "other")
+        self.write("conflict.txt", "other\n")
+        self.git("commit", "-q", "-a", "-m", "other")
+        self.git("checkout", "-q", "-")
+        self.write("conflict.txt", "mine\n")
+        self.git("commit", "-q", "-a", "-m", "mine")
+        # Fails, leaving conflict.txt unmerged
+        subprocess.call([ "git", "merge", "-q", "other" ], cwd = self.path,
+                        stdout = open(os.devnull, "w"), stderr = subprocess.STDOUT)
+
+        self.write("changed.txt", "two\n")
+
+    def tearDown(self):
+
+        shutil.rmtree(self.path, ignore_errors = True)
+
+    def git(self, *args):
+
+        subprocess.check_call(("git",) + args, cwd = self.path, stdout = open(os.devnull, "w"))
+
+    def write(self, fname, text):
+
+        with open(os.path.join(self.path, fname), "w") as fdesc:
+            fdesc.write(text)
+
+    def test_unmerged_is_dirty(self):
+
+        git = Git(self.path)
+        snapshot = git.status_snapshot()
+        self.assertTrue(snapshot.is_unmerged("conflict.txt"))
+        self.assertTrue(snapshot.is_dirty("conflict.txt"))
+        self.assertTrue(git.file_is_dirty("conflict.txt"))
+
+    def test_dirty_files(self):
+
+        git = Git(self.path)
+        self.assertEqual(git.dirty_files([ "changed.txt", "clean.txt", "conflict.txt" ]),
+                         [ "changed.txt", "conflict.txt" ])
+        self.assertFalse(git.file_is_dirty("clean.txt"))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,63 @@
+import os
+import shutil
+import tempfile
+import unittest
+import subprocess
+
+import utils
+from git import Git
+
+# ==================================================================================
+# RunStats on commands whose output is streamed: the command is credited to the Git
+# method that ran it, not to whoever was iterating over the output when git was done.
+
+class RunStatsTest(unittest.TestCase):
+
+    def setUp(self):
+
+        self.path = tempfile.mkdtemp(prefix = "test-run-")
+        def git(*args):
+            subprocess.check_call(("git",) + args, cwd = self.path, stdout = open(os.devnull, "w"))
+        git("init", "-q")
+        git("config", "user.email", "test@example.com")
+        git("config", "user.name", "Test")
+        with open(os.path.join(self.path, "file.txt"), "w") as fdesc:
+            fdesc.write("one\n")
+        git("add", "file.txt")
+        git("commit", "-q", "-m", "one")
+        with open(os.path.join(self.path, "file.txt"), "a") as fdesc:
+            fdesc.write("two\n")
+
+        self.stats = utils.RunStats().install()
+
+    def tearDown(self):
+
+        self.stats.uninstall()
+        shutil.rmtree(self.path, ignore_errors = True)
+
+    def methods(self):
+
+        return dict((name, stats['count']) for name, stats in self.stats.as_dict()['methods'].items())
+
+    def test_streamed_methods(self):
+
+        git = Git(self.path)
+        self.assertTrue(git.uncommitted_changes())
+        self.assertTrue(git.uncommitted_changes())
+        self.assertEqual(git.dirty_files([ "file.txt" ]), [ "file.txt" ])
+
+        methods = self.methods()
+        self.assertEqual(methods.get('uncommitted_changes'), 2)
+        self.assertEqual(methods.get('status_snapshot'), 1)
+        self.assertNotIn('stream_lines', methods)
+        self.assertNotIn('walk_diff', methods)
+
+    def test_generator_used_directly(self):
+
+        git = Git(self.path)
+        self.assertEqual(len(list(git.walk_commits("HEAD"))), 1)
+
+        self.assertEqual(self.methods(), { 'walk_commits': 1 })
+
+if __name__ == "__main__":
+    unittest.main()
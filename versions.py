@@ -0,0 +1,141 @@
+import bisect
+
+from revision import Revision
+
+# ==================================================================================
+# Version refs (e.g. refs/remotes/origin/v/master/0.0.10) of one branch, kept sorted
+# in Revision order - git sorts them alphanumerically, bringing 0.0.10 before 0.0.9.
+# The index follows the ref snapshot: when refs change, only new refs get a Revision
+# and are put in place (or sorted in, if there are many), removed ones are taken out.
+# Examples:
+#  index = VersionIndex("refs/remotes/origin/v/master/", "refs/remotes/origin/")
+#  index.update(git.ref_snapshot())
+#  index.max()                    ->  Revision('v/master/0.0.11')
+#  index.floor("v/master/0.0.10") ->  Revision('v/master/0.0.10')
+#  index.range("v/master/0.0.5", "v/master/0.0.9")  ->  [Revision('v/master/0.0.5'), ...]
+#  index.at('46dba5752ea0...')    ->  [Revision('v/master/0.0.9'), Revision('v/master/0.0.10')]
+
+class VersionIndex:
+
+    # All refs starting with 'prefix' are versions, named after what follows 'strip'
+    def __init__(self, prefix, strip = ""):
+
+        self.prefix = prefix
+        self.strip = strip
+        # The snapshot we're up to date with
+        self.snapshot = None
+        # Revisions in order, and the ref names they came from
+        self.revisions = []
+        self.names = []
+        # refname -> sha, refname -> Revision
+        self.shas = {}
+        self.by_name = {}
+        # sha -> Revisions (in order) pointing at it
+        self.by_sha = {}
+
+    def __len__(self):
+
+        return len(self.revisions)
+
+    # Brings the index up to date with the given refs.RefSnapshot,
+    # returns True if anything changed
+    def update(self, snapshot):
+
+        if snapshot is self.snapshot:
+            return False
+
+        shas = dict(snapshot.refs(self.prefix))
+        changed = False
+
+        removed = set(name for name in self.shas if name not in shas)
+        if removed:
+            for name in removed:
+                self.unmap(self.shas[name], self.by_name.pop(name))
+            kept = [ (revision, name) for revision, name in zip(self.revisions, self.names) if name not in removed ]
+            self.revisions = [ revision for revision, _name in kept ]
+            self.names = [ name for _revision, name in kept ]
+            changed = True
+
+        added = []
+        for name, sha in shas.iteritems():
+            if name not in self.shas:
+                revision = Revision(name[len(self.strip):])
+                added.append((revision, name))
+                self.by_name[name] = revision
+                self.map(sha, revision)
+                changed = True
+            elif self.shas[name] != sha:
+                self.unmap(self.shas[name], self.by_name[name])
+                self.map(sha, self.by_name[name])
+                changed = True
+
+        # A few are put in place, more (all of them, the first time) are sorted in at once
+        if len(added) * 16 < len(self.revisions):
+            for revision, name in added:
+                position = bisect.bisect_right(self.revisions, revision)
+                self.revisions.insert(position, revision)
+                self.names.insert(position, name)
+        elif added:
+            merged = sorted(zip(self.revisions, self.names) + added, key = lambda item: item[0])
+            self.revisions = [ revision for revision, _name in merged ]
+            self.names = [ name for _revision, name in merged ]
+
+        self.shas = shas
+        self.snapshot = snapshot
+        return changed
+
+    def map(self, sha, revision):
+
+        bisect.insort_right(self.by_sha.setdefault(sha, []), revision)
+
+    def unmap(self, sha, revision):
+
+        revisions = self.by_sha[sha]
+        for position, other in enumerate(revisions):
+            if other is revision:
+                del revisions[position]
+                break
+        if not revisions:
+            del self.by_sha[sha]
+
+    def revision(self, value):
+
+        if isinstance(value, basestring):
+            return Revision(value)
+        return value
+
+    def min(self):
+
+        if self.revisions:
+            return self.revisions[0]
+
+    def max(self):
+
+        if self.revisions:
+            return self.revisions[-1]
+
+    # The highest version not above the given one
+    def floor(self, revision):
+
+        position = bisect.bisect_right(self.revisions, self.revision(revision))
+        if position:
+            return self.revisions[position - 1]
+
+    # The lowest version not below the given one
+    def ceiling(self, revision):
+
+        position = bisect.bisect_left(self.revisions, self.revision(revision))
+        if position < len(self.revisions):
+            return self.revisions[position]
+
+    # Versions from low to high (both included), either may be None
+    def range(self, low = None, high = None):
+
+        start = bisect.bisect_left(self.revisions, self.revision(low)) if low is not None else 0
+        stop = bisect.bisect_right(self.revisions, self.revision(high)) if high is not None else len(self.revisions)
+        return self.revisions[start:stop]
+
+    # Versions pointing at the given full sha, lowest first
+    def at(self, sha):
+
+        return list(self.by_sha.get(sha, []))